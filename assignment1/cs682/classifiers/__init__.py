@@ -1,2 +1,5 @@
 from cs682.classifiers.k_nearest_neighbor import *
+from cs682.classifiers.knn_index import *
+from cs682.classifiers.knn_condense import *
 from cs682.classifiers.linear_classifier import *
+from cs682.classifiers.linear_sweep import *
@@ -1,13 +1,291 @@
+import multiprocessing
+from collections import namedtuple
+
 import numpy as np
 from scipy.spatial.distance import pdist, squareform
 
+from cs682.shared_array import (attach_array, release_on_collect,
+                                release_shared, share_array)
+
+# Default number of bytes the tiled distance engine may spend on distance
+# blocks at any one time.
+DEFAULT_MEMORY_BUDGET = 256 * 1024 ** 2
+
+# Number of training rows processed per tile by the tiled distance engine.
+TRAIN_BLOCK_SIZE = 2048
+
+
+def _row_sq_norms(X):
+  """ squared L2 norm of every row of X, without an (N, D) temporary """
+  if X.dtype.kind in 'iu':
+    # Integer rows are summed exactly in int64 instead of wrapping around.
+    return np.einsum('ij,ij->i', X, X, dtype=np.int64)
+  return np.einsum('ij,ij->i', X, X)
+
+
+def _as_integer(X, dtype):
+  """
+  Cast X to the integer dtype, raising a ValueError if that would change any
+  value (fractions or values out of range).
+  """
+  X_int = np.asarray(X).astype(dtype)
+  if not np.array_equal(X_int, X):
+    raise ValueError('Data cannot be stored exactly as %s' % np.dtype(dtype))
+  return X_int
+
+
+def _accumulator_dtype(dtype, dim):
+  """
+  Dtype to multiply integer rows of the given dtype and length dim in. Every
+  product and partial sum of a dot product is an integer, so float64 gives the
+  exact result as long as it stays below 2 ** 53 (always the case for uint8
+  and int16 images) and lets the product run through BLAS; numpy's own
+  integer matmul is an order of magnitude slower. Larger ranges fall back to
+  int64 accumulation.
+  """
+  info = np.iinfo(dtype)
+  max_abs = max(abs(int(info.min)), int(info.max))
+  if dim * max_abs * max_abs < 2 ** 53:
+    return np.float64
+  return np.int64
+
+
+def _sq_l2_kernel(X_block, X_block_sq, X_train, X_train_sq):
+  """
+  Squared L2 distances, as float64, between the rows of X_block and X_train
+  given their squared row norms. For integer training data every term is an
+  integer computed exactly, so the result is exact.
+  """
+  if X_train.dtype.kind in 'iu':
+    acc = _accumulator_dtype(X_train.dtype, X_train.shape[1])
+    cross = np.dot(X_block.astype(acc), X_train.T.astype(acc)).astype(np.int64)
+    tile = X_block_sq[:, np.newaxis] + X_train_sq[np.newaxis, :]
+    tile -= 2 * cross
+    return tile.astype(np.float64)
+  tile = np.dot(X_block, X_train.T)
+  tile *= -2
+  tile += X_block_sq[:, np.newaxis]
+  tile += X_train_sq[np.newaxis, :]
+  # Rounding can leave tiny negative values for coincident points.
+  np.maximum(tile, 0, out=tile)
+  return tile
+
+
+def _cosine_kernel(X_block, X_block_sq, X_train, X_train_sq):
+  """ cosine distances 1 - cos(x, t); all-zero rows count as unit length """
+  # Float rows are used as they are; integer rows are cast to float64, as
+  # _block_sizes accounts for.
+  tile = np.dot(X_block.astype(float, copy=False),
+                X_train.T.astype(float, copy=False))
+  block_norms = np.sqrt(X_block_sq.astype(float))
+  train_norms = np.sqrt(X_train_sq.astype(float))
+  block_norms[block_norms == 0] = 1
+  train_norms[train_norms == 0] = 1
+  tile /= block_norms[:, np.newaxis]
+  tile /= train_norms[np.newaxis, :]
+  np.subtract(1, tile, out=tile)
+  return tile
+
+
+def _l1_kernel(X_block, X_block_sq, X_train, X_train_sq):
+  """ L1 distances through one broadcast (test, train, D) block """
+  diff = X_block.astype(float)[:, np.newaxis, :] - X_train.astype(float)
+  np.abs(diff, out=diff)
+  return diff.sum(axis=2)
+
+
+def _chi2_kernel(X_block, X_block_sq, X_train, X_train_sq):
+  """
+  chi-squared distances 0.5 * sum((x - t) ** 2 / (x + t)) between histograms,
+  through broadcast (test, train, D) blocks; bins empty in both count as 0
+  """
+  a = X_block.astype(float)[:, np.newaxis, :]
+  b = X_train.astype(float)[np.newaxis, :, :]
+  num = a - b
+  num *= num
+  den = a + b
+  np.divide(num, den, out=num, where=den != 0)
+  num[den == 0] = 0
+  return 0.5 * num.sum(axis=2)
+
+
+# A distance metric for the tiled engine:
+# - kernel(X_block, X_block_sq, X_train, X_train_sq) returns a (test, train)
+#   tile of values that rank neighbors in the same order as the metric;
+# - finish maps such values to distances (None for the identity);
+# - expands tells whether the kernel materializes (test, train, D) blocks, in
+#   which case the engine shrinks its tiles to stay within the memory budget.
+Metric = namedtuple('Metric', ['kernel', 'finish', 'expands'])
+
+METRICS = {
+  'l2': Metric(_sq_l2_kernel, np.sqrt, False),
+  'sqeuclidean': Metric(_sq_l2_kernel, None, False),
+  'l1': Metric(_l1_kernel, None, True),
+  'cosine': Metric(_cosine_kernel, None, False),
+  'chi2': Metric(_chi2_kernel, None, True),
+}
+
+
+def register_metric(name, kernel, finish=None, expands=False):
+  """
+  Make a new distance metric available to KNearestNeighbor(metric=name); see
+  Metric for the meaning of the arguments.
+  """
+  METRICS[name] = Metric(kernel, finish, expands)
+
+
+def _finish(metric, values):
+  """ turn ranking values from a metric kernel into distances """
+  if metric.finish is None:
+    return values
+  return metric.finish(values)
+
+
+def _block_sizes(num_test, num_train, dim, metric, memory_budget,
+                 extra_row_bytes=0, integer=False):
+  """
+  Number of test and training rows per tile so that one tile, its merge
+  buffer and extra_row_bytes per test row fit in memory_budget. With integer
+  training data the kernels also hold float64 copies of the training rows of
+  the tile and of the test rows, which are counted as well.
+  """
+  train_block = min(num_train, TRAIN_BLOCK_SIZE)
+  # A tile entry and its merge buffer entry, plus up to three (test, train, D)
+  # temporaries for expanding kernels.
+  entry_bytes = 8 * 2
+  if metric.expands:
+    entry_bytes += 8 * 3 * dim
+    train_block = min(train_block,
+                      max(1, int(np.sqrt(memory_budget // entry_bytes))))
+  tile_bytes = 0
+  if integer:
+    # The integer cross term and its int64 copy are two more tile entries;
+    # the float64 copy of the training rows may take at most half the budget.
+    entry_bytes += 8 * 2
+    train_block = min(train_block, max(1, memory_budget // (2 * 8 * dim)))
+    tile_bytes = 8 * dim * train_block
+    extra_row_bytes += 8 * dim
+  row_bytes = 2 * entry_bytes * train_block + extra_row_bytes
+  test_block = int(max(1, min(num_test,
+                              (memory_budget - tile_bytes) // row_bytes)))
+  return test_block, train_block
+
+
+def select_topk(dists, idx, k):
+  """
+  Select the k smallest entries of every row of dists using a partial sort.
+
+  Inputs:
+  - dists: A numpy array of shape (N, M) of distances.
+  - idx: A numpy array of shape (N, M) giving the training index of every
+    entry in dists.
+  - k: Number of entries to keep per row; must satisfy k <= M.
+
+  Returns a tuple of:
+  - dists: A numpy array of shape (N, k) sorted in increasing order per row.
+  - idx: A numpy array of shape (N, k) of the matching training indices.
+    Equal distances are ordered by training index, so the result does not
+    depend on the order in which candidates were merged.
+  """
+  rows = np.arange(dists.shape[0])[:, np.newaxis]
+  if k < dists.shape[1]:
+    part = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    top_dists, top_idx = dists[rows, part], idx[rows, part]
+    # argpartition picks arbitrary entries among those tied with the kth
+    # distance; redo the (rare) rows with such ties by a full lexsort.
+    kth = top_dists.max(axis=1, keepdims=True)
+    tied = np.nonzero(np.sum(dists == kth, axis=1) >
+                      np.sum(top_dists == kth, axis=1))[0]
+    if len(tied) > 0:
+      order = np.lexsort((idx[tied], dists[tied]), axis=1)[:, :k]
+      tied_rows = tied[:, np.newaxis]
+      top_dists[tied] = dists[tied_rows, order]
+      top_idx[tied] = idx[tied_rows, order]
+    dists, idx = top_dists, top_idx
+  order = np.lexsort((idx, dists), axis=1)
+  return dists[rows, order], idx[rows, order]
+
+
+# Shared training arrays attached by each worker of a parallel search.
+_worker_arrays = {}
+
+
+def _attach_training_data(X_train_spec, X_train_sq_spec):
+  """ pool initializer: attach the shared training data once per worker """
+  _worker_arrays['X_train'] = attach_array(X_train_spec)
+  _worker_arrays['X_train_sq'] = attach_array(X_train_sq_spec)
+
+
+def _shard_neighbors(X_train, X_train_sq, lo, hi, X, k, memory_budget, metric):
+  """ top-k of the test points X over the training rows lo:hi """
+  shard = KNearestNeighbor(metric)
+  shard.X_train = X_train[lo:hi]
+  shard.X_train_sq = X_train_sq[lo:hi]
+  dists, idx = shard.compute_neighbors_tiled(X, k, memory_budget)
+  return dists, idx + lo
+
+
+def _search_shard(args):
+  """ pool task: local top-k of the test points X over the training rows lo:hi """
+  lo, hi, X, k, memory_budget, metric = args
+  return _shard_neighbors(_worker_arrays['X_train'][1],
+                          _worker_arrays['X_train_sq'][1],
+                          lo, hi, X, k, memory_budget, metric)
+
+
+def _fold_neighbors(X, X_sq, bounds, fold, k, memory_budget, metric):
+  """
+  top-k of the rows of one cross-validation fold over the rows of all other
+  folds, merged shard by shard so the other folds are never copied together
+  """
+  lo, hi = bounds[fold], bounds[fold + 1]
+  results = [_shard_neighbors(X, X_sq, bounds[g], bounds[g + 1], X[lo:hi],
+                              k, memory_budget, metric)
+             for g in range(len(bounds) - 1) if g != fold]
+  dists = np.hstack([d for d, _ in results])
+  idx = np.hstack([i for _, i in results])
+  return select_topk(dists, idx, min(k, idx.shape[1]))[1]
+
+
+def _search_fold(args):
+  """ pool task: nearest neighbor indices of one cross-validation fold """
+  bounds, fold, k, memory_budget, metric = args
+  return _fold_neighbors(_worker_arrays['X_train'][1],
+                         _worker_arrays['X_train_sq'][1],
+                         bounds, fold, k, memory_budget, metric)
+
+
+def _vote(labels, num_classes, weights=None):
+  """
+  most common label in every row of labels, counted for all rows with a
+  single offset bincount; ties go to the smallest label
+  """
+  num_test = labels.shape[0]
+  offsets = np.arange(num_test)[:, np.newaxis] * num_classes
+  counts = np.bincount((labels + offsets).ravel(), weights=weights,
+                       minlength=num_test * num_classes)
+  counts = counts.reshape(num_test, num_classes)
+  # argmax returns the first maximum, i.e. the smallest tied label.
+  return np.argmax(counts, axis=1)
+
+
 class KNearestNeighbor(object):
-  """ a kNN classifier with L2 distance """
+  """ a kNN classifier with L2 distance or another metric from METRICS """
 
-  def __init__(self):
-    pass
+  def __init__(self, metric='l2'):
+    """
+    Inputs:
+    - metric: Name of the distance metric in METRICS: 'l2' (default),
+      'sqeuclidean', 'l1', 'cosine' or 'chi2' (for histogram features such as
+      color_histogram_hsv). Metrics other than 'l2' are only supported by the
+      tiled, parallel and cross-validation paths; predict picks the tiled
+      engine for them automatically.
+    """
+    if metric not in METRICS:
+      raise ValueError('Unknown metric "%s"' % metric)
+    self.metric = metric
 
-  def train(self, X, y):
+  def train(self, X, y, index=None, dtype=None):
     """
     Train the classifier. For k-nearest neighbors this is just 
     memorizing the training data.
@@ -17,11 +295,50 @@ class KNearestNeighbor(object):
       consisting of num_train samples each of dimension D.
     - y: A numpy array of shape (N,) containing the training labels, where
          y[i] is the label for X[i].
+    - index: Optional approximate nearest-neighbor index, such as a
+      RandomProjectionLSH from cs682.classifiers.knn_index. It is fit on X
+      here and predict then queries it instead of scanning all of X. If the
+      index is a compressed store (its compressed attribute is true, as for
+      ProductQuantizer), the classifier keeps no reference to X, only y and
+      the index; the exact search paths then raise a ValueError.
+    - dtype: Optional integer dtype, such as np.uint8 for raw pixels or
+      np.int16, to store the training data in. Squared distances are then
+      computed in exact integer arithmetic, predictions match the float path
+      and the training set takes 8x (4x) less memory than float64. A
+      ValueError is raised if X cannot be represented exactly in dtype, or
+      if an index is given as well.
     """
-    self.X_train = X
+    if dtype is not None and index is not None:
+      raise ValueError('An index cannot be combined with an integer dtype; '
+                       'fit the index on the float data instead')
+    if dtype is not None:
+      X = _as_integer(X, dtype)
+    if index is not None and self.metric != 'l2':
+      raise ValueError('Approximate indices only support the l2 metric')
+    self.index = index
+    self.dtype = dtype
+    if getattr(self, '_shared', None) is not None:
+      # Release the shared-memory copies of the previous training data now
+      # rather than when the classifier is garbage collected.
+      self._shared[2]()
+    self._shared = None
+    self._groups = None
+    if index is not None:
+      index.fit(X)
     self.y_train = y
+    self.num_classes = np.max(y) + 1
+    if getattr(index, 'compressed', False):
+      # Keeping X here would undo the compression of the index.
+      self.X_train = None
+      self.X_train_sq = None
+      return
+    self.X_train = X
+    # Cache the squared norms of the training rows; the tiled distance engine
+    # reuses them for every query instead of recomputing X_train * X_train.
+    self.X_train_sq = _row_sq_norms(X)
     
-  def predict(self, X, k=1, num_loops=0):
+  def predict(self, X, k=1, num_loops=0, memory_budget=None, weighted=False,
+              n_jobs=None, prune=False):
     """
     Predict labels for test data using this classifier.
 
@@ -31,11 +348,46 @@ class KNearestNeighbor(object):
     - k: The number of nearest neighbors that vote for the predicted labels.
     - num_loops: Determines which implementation to use to compute distances
       between training points and testing points.
+    - memory_budget: If given, ignore num_loops and use the tiled distance
+      engine, keeping roughly at most memory_budget bytes of distances alive
+      instead of the full (num_test, num_train) matrix.
+    - weighted: If true, weight each neighbor's vote by its inverse distance.
+    - n_jobs: If greater than 1, search with compute_neighbors_parallel using
+      this many worker processes; num_loops is then ignored.
+    - prune: If true, search with the exact compute_neighbors_pruned (l2
+      metric only); num_loops and n_jobs are then ignored.
+
+    If the classifier was trained with an index, the neighbors come from the
+    index and num_loops, memory_budget and n_jobs are ignored. If it was
+    trained with an integer dtype or uses a metric other than 'l2', the tiled
+    engine is always used.
 
     Returns:
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
+    if self.index is not None:
+      dists, idx = self.index.query(X, k)
+      return self.vote(idx, dists if weighted else None)
+
+    if prune:
+      dists, idx = self.compute_neighbors_pruned(
+          X, k, memory_budget or DEFAULT_MEMORY_BUDGET)
+      return self.vote(idx, dists if weighted else None)
+
+    tiled_only = self.X_train.dtype.kind in 'iu' or self.metric != 'l2'
+    if tiled_only and memory_budget is None:
+      memory_budget = DEFAULT_MEMORY_BUDGET
+
+    if n_jobs is not None and n_jobs > 1:
+      dists, idx = self.compute_neighbors_parallel(
+          X, k, n_jobs, memory_budget or DEFAULT_MEMORY_BUDGET)
+      return self.vote(idx, dists if weighted else None)
+
+    if memory_budget is not None:
+      dists, idx = self.compute_neighbors_tiled(X, k, memory_budget)
+      return self.vote(idx, dists if weighted else None)
+
     if num_loops == 0:
       dists = self.compute_distances_no_loops(X)
     elif num_loops == 1:
@@ -45,7 +397,14 @@ class KNearestNeighbor(object):
     else:
       raise ValueError('Invalid value %d for num_loops' % num_loops)
 
-    return self.predict_labels(dists, k=k)
+    return self.predict_labels(dists, k=k, weighted=weighted)
+
+  def _check_training_data(self):
+    """ raise a ValueError if only a compressed index of X_train is kept """
+    if self.X_train is None:
+      raise ValueError('The classifier was trained with a compressed %s index '
+                       'and keeps no training data; only predict is '
+                       'available' % type(self.index).__name__)
 
   def compute_distances_two_loops(self, X):
     """
@@ -61,6 +420,7 @@ class KNearestNeighbor(object):
       is the Euclidean distance between the ith test point and the jth training
       point.
     """
+    self._check_training_data()
     num_test = X.shape[0]
     num_train = self.X_train.shape[0]
     dists = np.zeros((num_test, num_train))
@@ -85,6 +445,7 @@ class KNearestNeighbor(object):
 
     Input / Output: Same as compute_distances_two_loops
     """
+    self._check_training_data()
     num_test = X.shape[0]
     num_train = self.X_train.shape[0]
     dists = np.zeros((num_test, num_train))
@@ -107,6 +468,7 @@ class KNearestNeighbor(object):
 
     Input / Output: Same as compute_distances_two_loops
     """
+    self._check_training_data()
     num_test = X.shape[0]
     num_train = self.X_train.shape[0]
     dists = np.zeros((num_test, num_train)) 
@@ -122,6 +484,12 @@ class KNearestNeighbor(object):
     # HINT: Try to formulate the l2 distance using matrix multiplication    #
     #       and two broadcast sums.                                         #
     #########################################################################
+    if self.X_train.dtype.kind in 'iu':
+      # Squaring integer rows in their own dtype would wrap around; use the
+      # exact integer arithmetic of the tiled path instead.
+      X_int = self._query_block(X)
+      return np.sqrt(_sq_l2_kernel(X_int, _row_sq_norms(X_int), self.X_train,
+                                   self.X_train_sq))
     X_squared = X*X
     X_train_squared = self.X_train * self.X_train
     X_into_X_train_twice = 2*np.inner(X,self.X_train)
@@ -133,7 +501,419 @@ class KNearestNeighbor(object):
     #########################################################################
     return dists
 
-  def predict_labels(self, dists, k=1):
+  def _query_block(self, X_block):
+    """ bring a block of test rows into the representation of X_train """
+    if self.X_train.dtype.kind in 'iu':
+      return _as_integer(X_block, self.X_train.dtype)
+    return X_block
+
+  def compute_distances_tiled(self, X, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Compute the distance between each test point in X and each training point
+    in self.X_train by walking the test and training data in blocks, so that
+    only a strip of rows of the distance matrix is alive at any time.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - memory_budget: Approximate number of bytes the distance blocks may use.
+
+    Yields:
+    Tuples (start, stop, dists) where dists is a numpy array of shape
+    (stop - start, num_train) and dists[i, j] is the distance, under the
+    metric of this classifier, between the test point X[start + i] and the jth
+    training point.
+    """
+    self._check_training_data()
+    num_test, dim = X.shape
+    num_train = self.X_train.shape[0]
+    metric = METRICS[self.metric]
+    # Each test row in a block also costs one row of the returned strip.
+    test_block, train_block = _block_sizes(num_test, num_train, dim, metric,
+                                           memory_budget, 8 * num_train,
+                                           self.X_train.dtype.kind in 'iu')
+
+    for start in range(0, num_test, test_block):
+      stop = min(start + test_block, num_test)
+      X_block = self._query_block(X[start:stop])
+      X_block_sq = _row_sq_norms(X_block)
+      dists = np.empty((stop - start, num_train))
+      for lo in range(0, num_train, train_block):
+        hi = min(lo + train_block, num_train)
+        tile = dists[:, lo:hi]
+        tile[...] = _finish(metric, metric.kernel(
+            X_block, X_block_sq, self.X_train[lo:hi], self.X_train_sq[lo:hi]))
+      yield start, stop, dists
+
+  def compute_neighbors_tiled(self, X, k=1, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Find the k nearest training points of every test point in X without ever
+    materializing a full row of the distance matrix: each training tile is
+    reduced to its local top-k and merged into a running top-k per test point.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of nearest neighbors to return.
+    - memory_budget: Approximate number of bytes the distance blocks may use.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) with the distances to the
+      k nearest training points, sorted in increasing order.
+    - idx: A numpy array of shape (num_test, k) of indices into self.X_train
+      of the corresponding training points.
+    """
+    self._check_training_data()
+    num_test, dim = X.shape
+    num_train = self.X_train.shape[0]
+    k = min(k, num_train)
+    metric = METRICS[self.metric]
+    # Each test row also keeps its running top-k distances and indices.
+    test_block, train_block = _block_sizes(num_test, num_train, dim, metric,
+                                           memory_budget, 8 * 2 * k,
+                                           self.X_train.dtype.kind in 'iu')
+
+    best_dists = np.empty((num_test, k))
+    best_idx = np.empty((num_test, k), dtype=np.intp)
+    for start in range(0, num_test, test_block):
+      stop = min(start + test_block, num_test)
+      X_block = self._query_block(X[start:stop])
+      X_block_sq = _row_sq_norms(X_block)
+      run_dists = run_idx = None
+      for lo in range(0, num_train, train_block):
+        hi = min(lo + train_block, num_train)
+        tile = metric.kernel(X_block, X_block_sq, self.X_train[lo:hi],
+                             self.X_train_sq[lo:hi])
+        tile_idx = np.broadcast_to(np.arange(lo, hi), tile.shape)
+        if run_dists is not None:
+          tile = np.hstack((run_dists, tile))
+          tile_idx = np.hstack((run_idx, tile_idx))
+        run_dists, run_idx = select_topk(tile, tile_idx, k)
+      best_dists[start:stop] = _finish(metric, run_dists)
+      best_idx[start:stop] = run_idx
+    return best_dists, best_idx
+
+  def condense(self, method='kmeans', X_val=None, y_val=None, k=1, **kwargs):
+    """
+    Replace the training set by a much smaller reference set so that queries
+    get proportionally cheaper. The classifier is retrained on it with the
+    same index (which is fit again) and dtype as before.
+
+    Inputs:
+    - method: One of the condensers in cs682.classifiers.knn_condense:
+      'cnn' (condensed nearest neighbor), 'enn' (edited nearest neighbor) or
+      'kmeans' (per-class k-means prototypes).
+    - X_val, y_val: Optional validation data to measure the accuracy before
+      and after condensing.
+    - k: Number of neighbors used to measure the validation accuracy.
+    - kwargs: Passed on to the condenser, e.g. num_prototypes for 'kmeans'.
+
+    Returns:
+    A dictionary with the number of training rows before and after
+    ('num_before', 'num_after'), the 'reduction' factor and, if validation
+    data was given, 'accuracy_before', 'accuracy_after' and 'accuracy_delta'.
+    """
+    self._check_training_data()
+    from cs682.classifiers.knn_condense import CONDENSERS
+
+    if method not in CONDENSERS:
+      raise ValueError('Unknown condensing method "%s"' % method)
+    if method == 'kmeans' and self.dtype is not None:
+      raise ValueError('k-means prototypes cannot be stored in the integer '
+                       'dtype %s; train on float data to condense with '
+                       'kmeans' % np.dtype(self.dtype))
+    if method in ('cnn', 'enn'):
+      kwargs.setdefault('metric', self.metric)
+
+    report = {'num_before': self.X_train.shape[0]}
+    if X_val is not None:
+      y_pred = self.predict(X_val, k=k, memory_budget=DEFAULT_MEMORY_BUDGET)
+      report['accuracy_before'] = float(np.mean(y_pred == y_val))
+
+    X_ref, y_ref = CONDENSERS[method](self.X_train, self.y_train, **kwargs)
+    # Keep the index and integer storage the classifier was trained with.
+    self.train(X_ref, y_ref, index=self.index, dtype=self.dtype)
+
+    report['num_after'] = self.X_train.shape[0]
+    report['reduction'] = report['num_before'] / float(report['num_after'])
+    if X_val is not None:
+      y_pred = self.predict(X_val, k=k, memory_budget=DEFAULT_MEMORY_BUDGET)
+      report['accuracy_after'] = float(np.mean(y_pred == y_val))
+      report['accuracy_delta'] = (report['accuracy_after'] -
+                                  report['accuracy_before'])
+    return report
+
+  def build_pruning_groups(self, num_clusters=None, group_size=256,
+                           seed=None):
+    """
+    Partition the training rows into groups for compute_neighbors_pruned and
+    record, for every group, the smallest and largest row norm and, if
+    clusters are used, its centroid and radius.
+
+    Inputs:
+    - num_clusters: If given, first cluster the training rows with k-means
+      into this many clusters; groups then never straddle two clusters.
+      Otherwise the groups are runs of rows with similar norms.
+    - group_size: Maximum number of training rows per group.
+    - seed: Optional seed for k-means.
+    """
+    self._check_training_data()
+    norms = np.sqrt(self.X_train_sq.astype(float))
+    if num_clusters is None:
+      labels = np.zeros(len(norms), dtype=int)
+      centers = None
+    else:
+      from cs682.classifiers.knn_index import kmeans
+      centers, labels = kmeans(self.X_train.astype(float), num_clusters,
+                               seed=seed)
+
+    # Sort by cluster, then by norm, and cut every cluster into runs of at
+    # most group_size rows.
+    order = np.lexsort((norms, labels))
+    starts = []
+    for c in np.unique(labels):
+      lo, hi = np.searchsorted(labels[order], [c, c + 1])
+      starts.extend(range(lo, hi, group_size))
+    bounds = np.append(starts, len(order))
+
+    groups = {'order': order, 'bounds': bounds,
+              'min_norm': np.minimum.reduceat(norms[order], starts),
+              'max_norm': np.maximum.reduceat(norms[order], starts),
+              'centers': None, 'radii': None}
+    if centers is not None:
+      group_label = labels[order][starts]
+      diff = self.X_train[order].astype(float) - centers[labels[order]]
+      radius = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+      groups['centers'] = centers[group_label]
+      groups['radii'] = np.maximum.reduceat(radius, starts)
+    self._groups = groups
+    return groups
+
+  def compute_neighbors_pruned(self, X, k=1, memory_budget=DEFAULT_MEMORY_BUDGET,
+                               return_stats=False):
+    """
+    Find the exact k nearest training points (l2 metric) of every test point
+    in X, skipping groups of training rows that provably cannot contain one.
+
+    For a test point x and a group of training rows t, both
+    | ||x|| - ||t|| | (reverse triangle inequality, which is also the bound
+    ||x - t||^2 >= ||x||^2 + ||t||^2 - 2 ||x|| ||t|| from Cauchy-Schwarz) and,
+    for clustered groups, ||x - center|| - radius are lower bounds on
+    ||x - t||. Groups are visited in order of increasing lower bound; a group
+    is only scanned for the test points whose current k-th best distance it
+    could still beat, and the scan stops once no remaining group can beat
+    any of them. Groups come from build_pruning_groups, which is called with
+    its defaults if it has not been called since the last train.
+
+    Inputs: Same as compute_neighbors_tiled, plus:
+    - return_stats: If true, also return the fraction of (test point,
+      training row) distances that were actually computed.
+
+    Returns: Same as compute_neighbors_tiled.
+    """
+    self._check_training_data()
+    if self.metric != 'l2':
+      raise ValueError('Pruned search only supports the l2 metric')
+    if self._groups is None:
+      self.build_pruning_groups()
+    groups = self._groups
+    order, bounds = groups['order'], groups['bounds']
+    num_groups = len(bounds) - 1
+    group_rows = np.max(np.diff(bounds))
+
+    num_test, dim = X.shape
+    num_train = self.X_train.shape[0]
+    k = min(k, num_train)
+    test_block, _ = _block_sizes(num_test, num_train, dim, METRICS['l2'],
+                                 memory_budget, 8 * (2 * k + 2 * num_groups),
+                                 self.X_train.dtype.kind in 'iu')
+    test_block = min(test_block, max(1, memory_budget // (8 * 4 * group_rows)))
+
+    best_dists = np.empty((num_test, k))
+    best_idx = np.empty((num_test, k), dtype=np.intp)
+    scanned = 0
+    for start in range(0, num_test, test_block):
+      stop = min(start + test_block, num_test)
+      X_block = self._query_block(X[start:stop])
+      X_block_sq = _row_sq_norms(X_block)
+      norms = np.sqrt(X_block_sq.astype(float))[:, np.newaxis]
+
+      lb = np.maximum(norms - groups['max_norm'], groups['min_norm'] - norms)
+      if groups['centers'] is not None:
+        center_dists = np.sqrt(np.maximum(
+            X_block_sq.astype(float)[:, np.newaxis]
+            - 2 * X_block.astype(float).dot(groups['centers'].T)
+            + np.einsum('ij,ij->i', groups['centers'], groups['centers']), 0))
+        lb = np.maximum(lb, center_dists - groups['radii'])
+      lb = np.maximum(lb, 0)
+      # Squared bounds, loosened to absorb rounding in the computed distances
+      # so that pruning never drops a true neighbor.
+      slack = 1e-9 * (norms + groups['max_norm']) ** 2 + 1e-12
+      lb_sq = np.maximum(lb * lb - slack, 0)
+
+      visit = np.argsort(lb_sq.mean(axis=0), kind='stable')
+      # rest_lb[:, j] is the smallest bound among the groups visited from
+      # step j on, for every test point.
+      rest_lb = np.minimum.accumulate(lb_sq[:, visit[::-1]], axis=1)[:, ::-1]
+      rest_lb = np.hstack((rest_lb, np.full((stop - start, 1), np.inf)))
+
+      run_dists = np.full((stop - start, k), np.inf)
+      run_idx = np.full((stop - start, k), -1, dtype=np.intp)
+      for j, g in enumerate(visit):
+        active = np.nonzero(lb_sq[:, g] <= run_dists[:, -1])[0]
+        if len(active) > 0:
+          rows = order[bounds[g]:bounds[g + 1]]
+          tile = METRICS['l2'].kernel(X_block[active], X_block_sq[active],
+                                      self.X_train[rows], self.X_train_sq[rows])
+          scanned += tile.size
+          merged_dists = np.hstack((run_dists[active], tile))
+          merged_idx = np.hstack((run_idx[active],
+                                  np.broadcast_to(rows, tile.shape)))
+          run_dists[active], run_idx[active] = select_topk(
+              merged_dists, merged_idx, k)
+        if np.all(rest_lb[:, j + 1] > run_dists[:, -1]):
+          break
+      best_dists[start:stop] = np.sqrt(run_dists)
+      best_idx[start:stop] = run_idx
+
+    if return_stats:
+      return best_dists, best_idx, scanned / float(num_test * num_train)
+    return best_dists, best_idx
+
+  def shared_training_data(self):
+    """
+    Return picklable specs of shared-memory copies of self.X_train and
+    self.X_train_sq, creating the copies on first use. They are reused by
+    later parallel searches and released when the classifier is retrained or
+    garbage collected.
+    """
+    self._check_training_data()
+    if self._shared is None:
+      X_shm, X_spec = share_array(self.X_train)
+      sq_shm, sq_spec = share_array(self.X_train_sq)
+      self._shared = (X_spec, sq_spec,
+                      release_on_collect(self, X_shm, sq_shm))
+    return self._shared[:2]
+
+  def compute_neighbors_parallel(self, X, k=1, n_jobs=None,
+                                 memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Find the k nearest training points of every test point in X with a pool
+    of worker processes. The training data lives once in shared memory; each
+    worker owns one contiguous shard of it, returns the local top-k of every
+    test point over that shard, and the shards are merged here.
+
+    Each worker may also start its own BLAS threads; for the best throughput
+    limit BLAS to one thread per process (e.g. OMP_NUM_THREADS=1).
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of nearest neighbors to return.
+    - n_jobs: Number of worker processes; defaults to the number of CPUs.
+    - memory_budget: Approximate number of bytes the distance blocks of all
+      workers together may use.
+
+    Returns: Same as compute_neighbors_tiled.
+    """
+    self._check_training_data()
+    num_train = self.X_train.shape[0]
+    n_jobs = min(n_jobs or multiprocessing.cpu_count(), num_train)
+    k = min(k, num_train)
+    bounds = np.linspace(0, num_train, n_jobs + 1).astype(int)
+    tasks = [(lo, hi, X, k, memory_budget // n_jobs, self.metric)
+             for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+    pool = multiprocessing.Pool(n_jobs, initializer=_attach_training_data,
+                                initargs=self.shared_training_data())
+    try:
+      results = pool.map(_search_shard, tasks)
+    finally:
+      pool.close()
+      pool.join()
+
+    dists = np.hstack([d for d, _ in results])
+    idx = np.hstack([i for _, i in results])
+    return select_topk(dists, idx, k)
+
+  def cross_validate(self, X, y, k_choices, num_folds=5, n_jobs=None,
+                     memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Run num_folds-fold cross-validation for every k in k_choices at once.
+
+    X and y are split into num_folds contiguous folds. Every fold's neighbors
+    among the other folds are computed once, up to max(k_choices), and every
+    candidate k is scored on that same sorted neighbor list. This does not
+    change the training data of the classifier.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) containing the data to cross-validate on.
+    - y: A numpy array of shape (N,) containing the labels for X.
+    - k_choices: List of values of k to evaluate.
+    - num_folds: Number of folds.
+    - n_jobs: If greater than 1, process the folds in parallel with this many
+      worker processes sharing X through shared memory.
+    - memory_budget: Approximate number of bytes the distance blocks of each
+      fold may use.
+
+    Returns:
+    A dictionary mapping every k in k_choices to a list of length num_folds
+    giving the validation accuracy on each fold.
+    """
+    # Same fold boundaries as np.array_split(X, num_folds).
+    fold_sizes = [len(f) for f in np.array_split(y, num_folds)]
+    bounds = np.concatenate(([0], np.cumsum(fold_sizes)))
+    max_k = max(k_choices)
+    num_classes = np.max(y) + 1
+
+    if n_jobs is not None and n_jobs > 1:
+      X_shm, X_spec = share_array(X)
+      sq_shm, sq_spec = share_array(_row_sq_norms(X))
+      pool = multiprocessing.Pool(min(n_jobs, num_folds),
+                                  initializer=_attach_training_data,
+                                  initargs=(X_spec, sq_spec))
+      try:
+        neighbors = pool.map(_search_fold, [(bounds, f, max_k, memory_budget,
+                                             self.metric)
+                                            for f in range(num_folds)])
+      finally:
+        pool.close()
+        pool.join()
+        release_shared(X_shm, sq_shm)
+    else:
+      X_sq = _row_sq_norms(X)
+      neighbors = [_fold_neighbors(X, X_sq, bounds, f, max_k, memory_budget,
+                                   self.metric)
+                   for f in range(num_folds)]
+
+    k_to_accuracies = {k: [] for k in k_choices}
+    for f, idx in enumerate(neighbors):
+      y_fold = y[bounds[f]:bounds[f + 1]]
+      labels = y[idx]
+      for k in k_choices:
+        y_pred = _vote(labels[:, :k], num_classes)
+        k_to_accuracies[k].append(float(np.mean(y_pred == y_fold)))
+    return k_to_accuracies
+
+  def vote(self, neighbor_idx, neighbor_dists=None):
+    """
+    Predict a label for each test point from the indices of its nearest
+    training points, counting the votes for all test points at once.
+
+    Inputs:
+    - neighbor_idx: A numpy array of shape (num_test, k) of indices into
+      self.X_train.
+    - neighbor_dists: Optional numpy array of shape (num_test, k) with the
+      matching distances. If given, each neighbor votes with weight
+      1 / (distance + eps) instead of 1.
+
+    Returns:
+    - y: A numpy array of shape (num_test,) containing predicted labels.
+      Ties are broken by choosing the smaller label.
+    """
+    weights = None
+    if neighbor_dists is not None:
+      weights = (1.0 / (neighbor_dists + 1e-12)).ravel()
+    return _vote(self.y_train[neighbor_idx], self.num_classes, weights)
+
+  def predict_labels(self, dists, k=1, weighted=False):
     """
     Given a matrix of distances between test points and training points,
     predict a label for each test point.
@@ -141,37 +921,14 @@ class KNearestNeighbor(object):
     Inputs:
     - dists: A numpy array of shape (num_test, num_train) where dists[i, j]
       gives the distance betwen the ith test point and the jth training point.
+    - k: The number of nearest neighbors that vote for the predicted labels.
+    - weighted: If true, weight each vote by the inverse neighbor distance.
 
     Returns:
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
-    num_test = dists.shape[0]
-    y_pred = np.zeros(num_test)
-    for i in range(num_test):
-      # A list of length k storing the labels of the k nearest neighbors to
-      # the ith test point.
-      closest_y = []
-      #########################################################################
-      # TODO:                                                                 #
-      # Use the distance matrix to find the k nearest neighbors of the ith    #
-      # testing point, and use self.y_train to find the labels of these       #
-      # neighbors. Store these labels in closest_y.                           #
-      # Hint: Look up the function numpy.argsort.                             #
-      #########################################################################
-      closest_y = np.take(self.y_train ,np.argsort(dists[i])[0:k])
-      #########################################################################
-      # TODO:                                                                 #
-      # Now that you have found the labels of the k nearest neighbors, you    #
-      # need to find the most common label in the list closest_y of labels.   #
-      # Store this label in y_pred[i]. Break ties by choosing the smaller     #
-      # label.                                                                #
-      #########################################################################
-      closest_y_list = closest_y.tolist()
-      y_pred[i] = max(set(closest_y_list), key = closest_y_list.count)
-      #########################################################################
-      #                           END OF YOUR CODE                            # 
-      #########################################################################
-
-    return y_pred
-
+    k = min(k, dists.shape[1])
+    idx = np.broadcast_to(np.arange(dists.shape[1]), dists.shape)
+    closest_dists, closest_idx = select_topk(dists, idx, k)
+    return self.vote(closest_idx, closest_dists if weighted else None)
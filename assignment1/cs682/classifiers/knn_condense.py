@@ -0,0 +1,98 @@
+import numpy as np
+
+from cs682.classifiers.k_nearest_neighbor import (DEFAULT_MEMORY_BUDGET,
+                                                  KNearestNeighbor)
+from cs682.classifiers.knn_index import kmeans
+
+
+def condensed_nearest_neighbor(X, y, batch_size=1000, max_passes=10,
+                               metric='l2', seed=None,
+                               memory_budget=DEFAULT_MEMORY_BUDGET):
+  """
+  Hart's condensed nearest neighbor: grow a subset of (X, y) until 1-NN over
+  the subset classifies every row of X correctly.
+
+  The store starts with one row per class. The data is visited in a random
+  order in batches of batch_size rows; every row of a batch that 1-NN over the
+  current store misclassifies is added to the store, and passes are repeated
+  until a pass adds nothing or max_passes is reached. Adding a whole batch at
+  once instead of one row at a time keeps the search vectorized at the price
+  of a slightly larger store.
+
+  Returns a tuple (X_ref, y_ref) with the selected rows in their original
+  order.
+  """
+  rng = np.random.RandomState(seed)
+  visit = rng.permutation(X.shape[0])
+  in_store = np.zeros(X.shape[0], dtype=bool)
+  _, first = np.unique(y[visit], return_index=True)
+  in_store[visit[first]] = True
+
+  knn = KNearestNeighbor(metric)
+  for _ in range(max_passes):
+    added = False
+    for lo in range(0, len(visit), batch_size):
+      batch = visit[lo:lo + batch_size]
+      batch = batch[~in_store[batch]]
+      if len(batch) == 0:
+        continue
+      store = np.nonzero(in_store)[0]
+      knn.train(X[store], y[store])
+      y_pred = knn.predict(X[batch], k=1, memory_budget=memory_budget)
+      wrong = batch[y_pred != y[batch]]
+      if len(wrong) > 0:
+        in_store[wrong] = True
+        added = True
+    if not added:
+      break
+  return X[in_store], y[in_store]
+
+
+def edited_nearest_neighbor(X, y, k=3, metric='l2',
+                            memory_budget=DEFAULT_MEMORY_BUDGET):
+  """
+  Wilson's edited nearest neighbor: drop every row of X that is misclassified
+  by a vote of its k nearest other rows. This removes noisy and overlapping
+  points; it is a good step before condensed_nearest_neighbor.
+
+  Returns a tuple (X_ref, y_ref) with the kept rows in their original order.
+  """
+  num_train = X.shape[0]
+  # Every row can have at most num_train - 1 other rows voting on it.
+  k = min(k, num_train - 1)
+  if k < 1:
+    return X, y
+  knn = KNearestNeighbor(metric)
+  knn.train(X, y)
+  _, idx = knn.compute_neighbors_tiled(X, k + 1, memory_budget)
+
+  # Leave every row out of its own vote: drop the column holding the row
+  # itself, or the farthest neighbor if an exact duplicate displaced it.
+  is_self = idx == np.arange(num_train)[:, np.newaxis]
+  is_self[~is_self.any(axis=1), -1] = True
+  others = idx[~is_self].reshape(num_train, k)
+  keep = knn.vote(others) == y
+  return X[keep], y[keep]
+
+
+def class_prototypes(X, y, num_prototypes=10, num_iters=20, seed=None):
+  """
+  Replace the rows of every class by num_prototypes k-means centroids of that
+  class.
+
+  Returns a tuple (X_ref, y_ref) with the prototypes grouped by class.
+  """
+  X_ref, y_ref = [], []
+  for c in np.unique(y):
+    centroids, _ = kmeans(X[y == c].astype(float), num_prototypes, num_iters,
+                          seed=seed)
+    X_ref.append(centroids)
+    y_ref.append(np.full(len(centroids), c, dtype=y.dtype))
+  return np.vstack(X_ref), np.concatenate(y_ref)
+
+
+CONDENSERS = {
+  'cnn': condensed_nearest_neighbor,
+  'enn': edited_nearest_neighbor,
+  'kmeans': class_prototypes,
+}
@@ -0,0 +1,329 @@
+from __future__ import print_function
+
+import time
+
+import numpy as np
+
+from cs682.classifiers.k_nearest_neighbor import (DEFAULT_MEMORY_BUDGET,
+                                                  KNearestNeighbor, select_topk)
+
+
+def kmeans(X, num_clusters, num_iters=20, seed=None):
+  """
+  Lloyd's k-means with centroids initialized from random rows of X.
+
+  Inputs:
+  - X: A numpy array of shape (N, D).
+  - num_clusters: Number of centroids; clipped to N.
+  - num_iters: Number of assignment / update rounds.
+  - seed: Optional seed for the initialization.
+
+  Returns a tuple of:
+  - centroids: A numpy array of shape (num_clusters, D).
+  - labels: A numpy array of shape (N,) giving the centroid of every row.
+  """
+  rng = np.random.RandomState(seed)
+  num_clusters = min(num_clusters, X.shape[0])
+  centroids = X[rng.choice(X.shape[0], num_clusters, replace=False)].astype(float)
+  for it in range(num_iters + 1):
+    # Squared distances up to the per-row constant ||x||^2, which does not
+    # change the argmin.
+    d = np.einsum('ij,ij->i', centroids, centroids) - 2 * X.dot(centroids.T)
+    labels = np.argmin(d, axis=1)
+    if it == num_iters:
+      break
+    # Sum the rows of every cluster with one reduceat over the rows sorted by
+    # cluster. Empty clusters keep their previous centroid.
+    order = np.argsort(labels, kind='stable')
+    present, starts, counts = np.unique(labels[order], return_index=True,
+                                        return_counts=True)
+    sums = np.add.reduceat(X[order], starts, axis=0)
+    centroids[present] = sums / counts[:, np.newaxis]
+  return centroids, labels
+
+
+class RandomProjectionLSH(object):
+  """
+  Approximate nearest-neighbor index based on random-projection (sign) LSH.
+
+  Every hash table projects the centered data onto num_bits random hyperplanes
+  and buckets each point by the signs of its projections. A query collects the
+  training points sharing its bucket in any table, plus the buckets reached by
+  flipping its num_probes least certain bits, and ranks those candidates by
+  exact L2 distance.
+
+  More tables and more probes give a higher recall at the price of more
+  candidates per query; more bits give smaller buckets and faster queries.
+  """
+
+  def __init__(self, num_tables=8, num_bits=12, num_probes=2, seed=None):
+    """
+    Inputs:
+    - num_tables: Number of independent hash tables.
+    - num_bits: Number of hyperplanes, i.e. hash bits, per table.
+    - num_probes: Number of extra buckets probed per table, obtained by
+      flipping the bits whose projections are closest to zero.
+    - seed: Optional seed for the random hyperplanes.
+    """
+    self.num_tables = num_tables
+    self.num_bits = num_bits
+    self.num_probes = min(num_probes, num_bits)
+    self.seed = seed
+
+  def fit(self, X):
+    """
+    Build the hash tables for the training data X of shape (N, D).
+    """
+    rng = np.random.RandomState(self.seed)
+    self.X = X
+    # Accumulate in float64 so integer data such as raw uint8 pixels does not
+    # wrap around.
+    self.X_sq = np.einsum('ij,ij->i', X, X, dtype=np.float64)
+    self.mean = X.mean(axis=0)
+    self.planes = rng.randn(self.num_tables, X.shape[1], self.num_bits)
+    self.bit_values = 1 << np.arange(self.num_bits)
+
+    # For every table keep the training indices sorted by bucket code, plus the
+    # distinct codes and where each of their runs starts in that order.
+    self.tables = []
+    for t in range(self.num_tables):
+      codes = self._codes(self._project(X, t))
+      order = np.argsort(codes, kind='stable')
+      keys, starts = np.unique(codes[order], return_index=True)
+      stops = np.append(starts[1:], len(order))
+      self.tables.append((keys, starts, stops, order))
+    return self
+
+  def _project(self, X, t):
+    return (X - self.mean).dot(self.planes[t])
+
+  def _codes(self, proj):
+    return (proj > 0).dot(self.bit_values)
+
+  def candidates(self, X):
+    """
+    Return a list with, for every query row of X, the array of training
+    indices that share a probed bucket with it.
+    """
+    num_test = X.shape[0]
+    probes = [[] for _ in range(num_test)]
+    for t, (keys, starts, stops, order) in enumerate(self.tables):
+      proj = self._project(X, t)
+      codes = self._codes(proj)
+      # Flip the least certain bits to reach neighboring buckets.
+      flips = np.argsort(np.abs(proj), axis=1)[:, :self.num_probes]
+      probe_codes = np.hstack((codes[:, np.newaxis],
+                               codes[:, np.newaxis] ^ self.bit_values[flips]))
+      pos = np.searchsorted(keys, probe_codes)
+      pos = np.minimum(pos, len(keys) - 1)
+      hit = keys[pos] == probe_codes
+      for i, j in zip(*np.nonzero(hit)):
+        probes[i].append(order[starts[pos[i, j]]:stops[pos[i, j]]])
+    return [np.unique(np.concatenate(p)) if p else np.array([], dtype=np.intp)
+            for p in probes]
+
+  def query(self, X, k=1):
+    """
+    Find approximate k nearest neighbors of every row of X.
+
+    Queries whose probed buckets hold fewer than k training points fall back
+    to an exact scan over the whole training set.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) of L2 distances, sorted in
+      increasing order per row.
+    - idx: A numpy array of shape (num_test, k) of training indices.
+    """
+    num_test = X.shape[0]
+    k = min(k, self.X.shape[0])
+    dists = np.empty((num_test, k))
+    idx = np.empty((num_test, k), dtype=np.intp)
+    all_rows = np.arange(self.X.shape[0])
+    for i, cand in enumerate(self.candidates(X)):
+      if len(cand) < k:
+        cand = all_rows
+      x = X[i].astype(np.float64)
+      d = self.X_sq[cand] - 2 * self.X[cand].dot(x) + x.dot(x)
+      top = np.argpartition(d, k - 1)[:k] if k < len(cand) else np.arange(k)
+      top = top[np.lexsort((cand[top], d[top]))]
+      dists[i] = np.sqrt(np.maximum(d[top], 0))
+      idx[i] = cand[top]
+    return dists, idx
+
+
+class ProductQuantizer(object):
+  """
+  Compressed training store for kNN based on product quantization.
+
+  The feature dimensions are split into num_subspaces groups and every group
+  gets its own k-means codebook, so each training row is stored as
+  num_subspaces small integer codes instead of D floats. Queries use
+  asymmetric distances: the query stays exact, the distances from each of its
+  sub-vectors to every codeword are put in a lookup table, and the distance to
+  a training row is the sum of num_subspaces table entries. The cost per
+  training row therefore depends on num_subspaces rather than on D.
+
+  With rerank > 0 the best rerank candidates by approximate distance are
+  re-scored with exact distances against the original rows. Those rows are
+  only read for the candidates, so X can be a memory-mapped array.
+  """
+  # KNearestNeighbor.train keeps no copy of the training data next to a
+  # compressed store.
+  compressed = True
+
+  def __init__(self, num_subspaces=8, num_centroids=256, num_iters=20,
+               rerank=0, train_size=20000, seed=None):
+    """
+    Inputs:
+    - num_subspaces: Number of sub-vector groups M the dimensions are split into.
+    - num_centroids: Codebook size per subspace; at most 256 keeps codes uint8.
+    - num_iters: Number of k-means iterations per codebook.
+    - rerank: Number of approximate candidates to re-rank exactly per query; 0
+      disables re-ranking.
+    - train_size: Number of random rows the codebooks are learned from; None
+      uses every row.
+    - seed: Optional seed for sampling and k-means initialization.
+    """
+    self.num_subspaces = num_subspaces
+    self.num_centroids = num_centroids
+    self.num_iters = num_iters
+    self.rerank = rerank
+    self.train_size = train_size
+    self.seed = seed
+
+  def fit(self, X):
+    """
+    Learn the codebooks on (a sample of) X of shape (N, D) and encode X.
+    """
+    rng = np.random.RandomState(self.seed)
+    num_train, dim = X.shape
+    sample = np.arange(num_train)
+    if self.train_size is not None and self.train_size < num_train:
+      sample = np.sort(rng.choice(num_train, self.train_size, replace=False))
+    code_dtype = np.uint8 if self.num_centroids <= 256 else np.uint16
+
+    self.subspaces = np.array_split(np.arange(dim), self.num_subspaces)
+    self.codebooks = []
+    self.codes = np.empty((num_train, self.num_subspaces), dtype=code_dtype)
+    for m, dims in enumerate(self.subspaces):
+      sub = X[:, dims[0]:dims[-1] + 1]
+      codebook, _ = kmeans(sub[sample].astype(float), self.num_centroids,
+                           self.num_iters, seed=rng.randint(2 ** 31))
+      self.codebooks.append(codebook)
+      for lo in range(0, num_train, 10000):
+        block = sub[lo:lo + 10000].astype(float)
+        d = np.einsum('ij,ij->i', codebook, codebook) - 2 * block.dot(codebook.T)
+        self.codes[lo:lo + 10000, m] = np.argmin(d, axis=1)
+    self.X = X if self.rerank > 0 else None
+    return self
+
+  def memory_bytes(self):
+    """ number of bytes taken by the codes and codebooks """
+    return self.codes.nbytes + sum(c.nbytes for c in self.codebooks)
+
+  def distance_tables(self, X):
+    """
+    Squared distances from every sub-vector of every query row of X to every
+    codeword of its subspace, as a list of num_subspaces arrays of shape
+    (num_test, num_centroids).
+    """
+    tables = []
+    for dims, codebook in zip(self.subspaces, self.codebooks):
+      sub = X[:, dims[0]:dims[-1] + 1]
+      t = sub.dot(codebook.T)
+      t *= -2
+      t += np.einsum('ij,ij->i', sub, sub, dtype=np.float64)[:, np.newaxis]
+      t += np.einsum('ij,ij->i', codebook, codebook)[np.newaxis, :]
+      tables.append(t)
+    return tables
+
+  def query(self, X, k=1, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Find approximate k nearest neighbors of every row of X.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) of L2 distances, sorted in
+      increasing order per row; approximate unless re-ranking is enabled.
+    - idx: A numpy array of shape (num_test, k) of training indices.
+    """
+    num_test = X.shape[0]
+    num_train = self.codes.shape[0]
+    k = min(k, num_train)
+    num_cand = min(max(k, self.rerank), num_train)
+    test_block = int(max(1, min(num_test, memory_budget // (8 * 2 * num_train))))
+
+    dists = np.empty((num_test, k))
+    idx = np.empty((num_test, k), dtype=np.intp)
+    all_idx = np.arange(num_train)
+    for start in range(0, num_test, test_block):
+      stop = min(start + test_block, num_test)
+      tables = self.distance_tables(X[start:stop])
+      approx = np.zeros((stop - start, num_train))
+      for m, table in enumerate(tables):
+        approx += table[:, self.codes[:, m]]
+      cand_dists, cand_idx = select_topk(
+          approx, np.broadcast_to(all_idx, approx.shape), num_cand)
+      if self.X is not None:
+        # Read candidate rows in increasing order, which is much friendlier to
+        # a memory-mapped X.
+        cand_idx = np.sort(cand_idx, axis=1)
+        cand_dists = np.empty(cand_idx.shape)
+        for i in range(stop - start):
+          diff = self.X[cand_idx[i]].astype(float) - X[start + i]
+          cand_dists[i] = np.einsum('ij,ij->i', diff, diff)
+      top_dists, top_idx = select_topk(cand_dists, cand_idx, k)
+      dists[start:stop] = np.sqrt(np.maximum(top_dists, 0))
+      idx[start:stop] = top_idx
+    return dists, idx
+
+
+def recall_at_k(approx_idx, exact_idx):
+  """
+  Fraction of the exact k nearest neighbors that an approximate search found,
+  averaged over all queries.
+
+  Inputs:
+  - approx_idx: A numpy array of shape (num_test, k) of training indices
+    returned by an approximate search.
+  - exact_idx: A numpy array of shape (num_test, k) of the true k nearest
+    training indices.
+  """
+  k = exact_idx.shape[1]
+  hits = sum(len(np.intersect1d(a, e)) for a, e in zip(approx_idx, exact_idx))
+  return hits / float(exact_idx.size) if k > 0 else 1.0
+
+
+def benchmark_index(classifier, X, k=1, verbose=True, X_train=None):
+  """
+  Compare the approximate index of a trained KNearestNeighbor against the
+  exact compute_distances_no_loops result on the queries in X.
+
+  A classifier trained with a compressed index such as ProductQuantizer keeps
+  no training data, so for it the training data must be passed as X_train.
+
+  Returns a dictionary with the keys 'recall' (recall@k), 'exact_time' and
+  'index_time' (seconds for all queries) and 'speedup'.
+  """
+  exact = classifier
+  if X_train is not None:
+    exact = KNearestNeighbor()
+    exact.train(X_train, classifier.y_train)
+  tic = time.time()
+  dists = exact.compute_distances_no_loops(X)
+  exact_idx = np.argsort(dists, axis=1, kind='stable')[:, :k]
+  exact_time = time.time() - tic
+
+  tic = time.time()
+  _, approx_idx = classifier.index.query(X, k)
+  index_time = time.time() - tic
+
+  result = {
+    'recall': recall_at_k(approx_idx, exact_idx),
+    'exact_time': exact_time,
+    'index_time': index_time,
+    'speedup': exact_time / max(index_time, 1e-12),
+  }
+  if verbose:
+    print('recall@%d: %f, exact: %fs, index: %fs (%.1fx)' % (
+        k, result['recall'], exact_time, index_time, result['speedup']))
+  return result
@@ -1,22 +1,117 @@
 from __future__ import print_function
 
+import time
+
 import numpy as np
+from scipy.optimize import minimize
+
 from cs682.classifiers.linear_svm import *
 from cs682.classifiers.softmax import *
 
+# Minibatch sampling schemes accepted by LinearClassifier.train.
+SAMPLING_MODES = ('random', 'epoch', 'contiguous')
+
+
+class MinibatchSampler(object):
+  """
+  Draw minibatches that visit every training example once per epoch.
+
+  - 'epoch': Shuffle the example indices at the start of every epoch and
+    gather each batch into two preallocated buffers with np.take, so drawing
+    a batch allocates nothing. Batches always have batch_size rows; a batch
+    that crosses the end of an epoch continues with the next permutation.
+  - 'contiguous': Keep one shuffled copy of X and y and return contiguous
+    slices of it, in a new random order every epoch. This copies nothing per
+    batch at the price of a second copy of X and a fixed batch composition;
+    the last batch of an epoch may be smaller.
+
+  The returned X_batch and y_batch are only valid until the next call to
+  next_batch.
+  """
+
+  def __init__(self, X, y, batch_size, mode='epoch', seed=None):
+    if mode not in ('epoch', 'contiguous'):
+      raise ValueError('Unknown sampling mode "%s"' % mode)
+    self.X = X
+    self.y = y
+    self.batch_size = batch_size
+    self.mode = mode
+    self.rng = np.random if seed is None else np.random.RandomState(seed)
+    self.epoch = 0
+    self._pos = 0
+    num_train = X.shape[0]
+    if mode == 'epoch':
+      self._order = np.arange(num_train)
+      self._idx = np.empty(batch_size, dtype=np.intp)
+      self._X_batch = np.empty((batch_size,) + X.shape[1:], dtype=X.dtype)
+      self._y_batch = np.empty(batch_size, dtype=y.dtype)
+    else:
+      perm = self.rng.permutation(num_train)
+      self._X_shuffled = X[perm]
+      self._y_shuffled = y[perm]
+      self._order = np.arange(0, num_train, batch_size)
+    self.rng.shuffle(self._order)
+
+  def next_batch(self):
+    """ return the next minibatch as a tuple (X_batch, y_batch) """
+    if self.mode == 'contiguous':
+      if self._pos == len(self._order):
+        self._next_epoch()
+      start = self._order[self._pos]
+      self._pos += 1
+      stop = start + self.batch_size
+      return self._X_shuffled[start:stop], self._y_shuffled[start:stop]
+
+    filled = 0
+    while filled < self.batch_size:
+      if self._pos == len(self._order):
+        self._next_epoch()
+      count = min(self.batch_size - filled, len(self._order) - self._pos)
+      self._idx[filled:filled + count] = self._order[self._pos:self._pos + count]
+      self._pos += count
+      filled += count
+    # The indices are always in range; mode='clip' skips the bounds check,
+    # with which np.take gathers into a temporary and copies it to out.
+    np.take(self.X, self._idx, axis=0, out=self._X_batch, mode='clip')
+    np.take(self.y, self._idx, out=self._y_batch, mode='clip')
+    return self._X_batch, self._y_batch
+
+  def _next_epoch(self):
+    self.rng.shuffle(self._order)
+    self._pos = 0
+    self.epoch += 1
+
+
 class LinearClassifier(object):
 
-  def __init__(self):
+  def __init__(self, dtype=None):
+    """
+    Inputs:
+    - dtype: Floating point type of the weights and of all computations in
+      train, such as np.float32. If None, float32 training data is trained
+      in float32 and anything else in float64.
+    """
     self.W = None
+    self.dtype = dtype
+
+  def compute_dtype(self, X):
+    """ floating point type that train uses for data X """
+    if self.dtype is not None:
+      return np.dtype(self.dtype)
+    if X.dtype == np.float32:
+      return X.dtype
+    return np.dtype(np.float64)
 
   def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, sampling='random', seed=None):
     """
     Train this linear classifier using stochastic gradient descent.
 
     Inputs:
     - X: A numpy array of shape (N, D) containing training data; there are N
-      training samples each of dimension D.
+      training samples each of dimension D. X is converted once to the
+      floating point type given by compute_dtype, and W, the scores, the
+      gradients and the updates all stay in that type.
     - y: A numpy array of shape (N,) containing training labels; y[i] = c
       means that X[i] has label 0 <= c < C for C classes.
     - learning_rate: (float) learning rate for optimization.
@@ -24,15 +119,30 @@ class LinearClassifier(object):
     - num_iters: (integer) number of steps to take when optimizing
     - batch_size: (integer) number of training examples to use at each step.
     - verbose: (boolean) If true, print progress during optimization.
+    - sampling: (string) How minibatches are drawn. 'random' samples every
+      batch independently with replacement. 'epoch' and 'contiguous' visit
+      every example once per epoch without allocating per-iteration copies;
+      see MinibatchSampler.
+    - seed: (integer) Seed for the 'epoch' and 'contiguous' samplers; if None
+      they use the global numpy random state.
 
     Outputs:
     A list containing the value of the loss function at each training iteration.
     """
+    dtype = self.compute_dtype(X)
+    X = np.asarray(X, dtype=dtype)
     num_train, dim = X.shape
     num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
-    if self.W is None:
-      # lazily initialize W
-      self.W = 0.001 * np.random.randn(dim, num_classes)
+    self._init_weights(dim, num_classes, dtype)
+
+    if sampling not in SAMPLING_MODES:
+      raise ValueError('Unknown sampling mode "%s"' % sampling)
+    sampler = None
+    if sampling != 'random':
+      sampler = MinibatchSampler(X, y, batch_size, sampling, seed)
+
+    # Temporaries of the loss function, reused across iterations.
+    workspace = {}
 
     # Run stochastic gradient descent to optimize W
     loss_history = []
@@ -48,15 +158,18 @@ class LinearClassifier(object):
       # Hint: Use np.random.choice to generate indices. Sampling with         #
       # replacement is faster than sampling without replacement.              #
       #########################################################################
-      newMask = np.random.choice(X.shape[0], batch_size, replace=True)
-      X_batch = X[newMask]
-      y_batch = y[newMask]
+      if sampler is not None:
+        X_batch, y_batch = sampler.next_batch()
+      else:
+        newMask = np.random.choice(X.shape[0], batch_size, replace=True)
+        X_batch = X[newMask]
+        y_batch = y[newMask]
       #########################################################################
       #                       END OF YOUR CODE                                #
       #########################################################################
 
       # evaluate loss and gradient
-      loss, grad = self.loss(X_batch, y_batch, reg)
+      loss, grad = self.loss(X_batch, y_batch, reg, workspace)
       loss_history.append(loss)
 
       # perform parameter update
@@ -64,7 +177,8 @@ class LinearClassifier(object):
       # TODO:                                                                 #
       # Update the weights using the gradient and the learning rate.          #
       #########################################################################
-      self.W -= grad*learning_rate
+      grad *= learning_rate
+      self.W -= grad
       #########################################################################
       #                       END OF YOUR CODE                                #
       #########################################################################
@@ -74,6 +188,104 @@ class LinearClassifier(object):
 
     return loss_history
 
+  def train_lbfgs(self, X, y, reg=1e-5, max_iter=100, gtol=1e-5, ftol=1e-9,
+                  chunk_size=10000, smoothing=0.5, X_val=None, y_val=None,
+                  verbose=False):
+    """
+    Train this linear classifier with full-batch L-BFGS instead of SGD.
+
+    Every iteration evaluates the loss and gradient over all of X, chunk_size
+    rows at a time with the same loss functions as train, and lets
+    scipy.optimize.minimize pick the step, so there is no learning rate to
+    tune and far fewer passes over the data are needed than with SGD. The
+    hinge loss of LinearSVM is not differentiable, so it is replaced by a
+    smoothed hinge (see svm_loss_vectorized).
+
+    Inputs:
+    - X, y, reg: As for train.
+    - max_iter: (integer) maximum number of L-BFGS iterations.
+    - gtol: (float) stop when the largest gradient entry is below gtol.
+    - ftol: (float) stop when an iteration reduces the loss by less than this
+      fraction.
+    - chunk_size: (integer) number of rows of X evaluated at once, which
+      bounds the size of the temporaries.
+    - smoothing: (float) width of the smoothed hinge for LinearSVM; ignored
+      by Softmax.
+    - X_val, y_val: Optional validation data, evaluated after every iteration.
+    - verbose: (boolean) If true, print progress after every iteration.
+
+    Returns:
+    A dictionary of lists with one entry per iteration: 'loss', 'time' (seconds
+    since the start) and, if X_val is given, 'val_accuracy'.
+    """
+    dtype = self.compute_dtype(X)
+    X = np.asarray(X, dtype=dtype)
+    num_classes = np.max(y) + 1
+    self._init_weights(X.shape[1], num_classes, dtype)
+    shape = self.W.shape
+
+    workspace = {}
+    evaluated = {}
+
+    def objective(w):
+      # L-BFGS works in float64; the loss is evaluated in dtype.
+      self.W = w.reshape(shape).astype(dtype)
+      loss, grad = self.full_batch_loss(X, y, reg, chunk_size, smoothing,
+                                        workspace)
+      evaluated['loss'] = loss
+      return loss, grad.ravel().astype(np.float64)
+
+    history = {'loss': [], 'time': []}
+    if X_val is not None:
+      history['val_accuracy'] = []
+    start = time.time()
+
+    def callback(w):
+      history['loss'].append(evaluated['loss'])
+      history['time'].append(time.time() - start)
+      if X_val is not None:
+        self.W = w.reshape(shape).astype(dtype)
+        history['val_accuracy'].append(float(np.mean(self.predict(X_val) == y_val)))
+      if verbose:
+        print('iteration %d / %d: loss %f' % (len(history['loss']), max_iter,
+                                              evaluated['loss']))
+
+    result = minimize(objective, self.W.ravel().astype(np.float64), jac=True,
+                      method='L-BFGS-B', callback=callback,
+                      options={'maxiter': max_iter, 'gtol': gtol,
+                               'ftol': ftol})
+    self.W = result.x.reshape(shape).astype(dtype)
+    return history
+
+  def full_batch_loss(self, X, y, reg, chunk_size=10000, smoothing=0.0,
+                      workspace=None):
+    """
+    Loss and gradient of self.smooth_loss over all of X, evaluated chunk_size
+    rows at a time.
+    """
+    if workspace is None:
+      workspace = {}
+    num_train = X.shape[0]
+    loss, grad = 0.0, np.zeros_like(self.W)
+    for start in range(0, num_train, chunk_size):
+      X_chunk, y_chunk = X[start:start + chunk_size], y[start:start + chunk_size]
+      chunk_loss, chunk_grad = self.smooth_loss(X_chunk, y_chunk, 0.0,
+                                                smoothing, workspace)
+      weight = X_chunk.shape[0] / float(num_train)
+      loss += chunk_loss * weight
+      chunk_grad *= weight
+      grad += chunk_grad
+    loss += reg * np.sum(self.W * self.W, dtype=np.float64)
+    grad += 2 * reg * self.W
+    return loss, grad
+
+  def _init_weights(self, dim, num_classes, dtype):
+    if self.W is None:
+      # lazily initialize W
+      self.W = (0.001 * np.random.randn(dim, num_classes)).astype(dtype)
+    else:
+      self.W = self.W.astype(dtype, copy=False)
+
   def predict(self, X):
     """
     Use the trained weights of this linear classifier to predict labels for
@@ -100,7 +312,7 @@ class LinearClassifier(object):
     ###########################################################################
     return y_pred
 
-  def loss(self, X_batch, y_batch, reg):
+  def loss(self, X_batch, y_batch, reg, workspace=None):
     """
     Compute the loss function and its derivative.
     Subclasses will override this.
@@ -110,6 +322,8 @@ class LinearClassifier(object):
       data points; each point has dimension D.
     - y_batch: A numpy array of shape (N,) containing labels for the minibatch.
     - reg: (float) regularization strength.
+    - workspace: Optional dict in which the loss function may keep temporary
+      arrays between calls; train passes the same dict on every iteration.
 
     Returns: A tuple containing:
     - loss as a single float
@@ -117,16 +331,341 @@ class LinearClassifier(object):
     """
     pass
 
+  def smooth_loss(self, X_batch, y_batch, reg, smoothing, workspace=None):
+    """
+    Differentiable version of loss used by train_lbfgs, with non-smooth
+    parts smoothed over a width of smoothing. Losses that are already
+    smooth need not override this.
+    """
+    return self.loss(X_batch, y_batch, reg, workspace)
+
 
 class LinearSVM(LinearClassifier):
   """ A subclass that uses the Multiclass SVM loss function """
 
-  def loss(self, X_batch, y_batch, reg):
-    return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
+  def loss(self, X_batch, y_batch, reg, workspace=None):
+    return svm_loss_vectorized(self.W, X_batch, y_batch, reg, workspace)
+
+  def smooth_loss(self, X_batch, y_batch, reg, smoothing, workspace=None):
+    return svm_loss_vectorized(self.W, X_batch, y_batch, reg, workspace,
+                               smoothing)
+
+  def train_dual_cd(self, X, y, reg=1e-5, max_passes=50, tol=0.1,
+                    shrinking=True, seed=None, verbose=False):
+    """
+    Train one-vs-rest linear SVMs by dual coordinate descent, as liblinear
+    does for the L1-loss SVM, without a learning rate.
+
+    Column c of W is the solution of the binary SVM separating class c from
+    all others, min_w 1/2 |w|^2 + C sum_i max(0, 1 - s_i w.x_i) with s_i = +1
+    if y[i] == c and -1 otherwise, and C = 1 / (2 * reg * N) so that reg has
+    the same scale as in train. This is the one-vs-rest hinge loss rather
+    than the multiclass loss of svm_loss_vectorized, but W is used by predict
+    the same way. As in the rest of this assignment, append a constant
+    feature to X for a bias.
+
+    Each pass visits the training examples in a random order and, for every
+    example, solves its C one-dimensional dual problems exactly in closed form
+    using the cached squared norm of the row, updating all columns of W with
+    one rank-one update. With shrinking, examples whose dual variables are
+    all stuck at a bound are dropped from later passes; all examples are
+    checked again before stopping.
+
+    Inputs:
+    - X, y, reg: As for train.
+    - max_passes: (integer) maximum number of passes over the examples.
+    - tol: (float) stop when the largest violation of the optimality
+      conditions, measured by the projected gradient, is below tol.
+    - shrinking: (boolean) whether to drop examples at a bound.
+    - seed: (integer) seed of the visiting order; if None the global numpy
+      random state is used.
+    - verbose: (boolean) If true, print progress after every pass.
+
+    Returns:
+    A dictionary of lists with one entry per pass: 'violation' (the largest
+    projected gradient range), 'active' (the number of examples visited) and
+    'time' (seconds since the start). If max_passes runs out before the
+    violation drops below tol a warning is printed and W is not converged.
+    """
+    dtype = self.compute_dtype(X)
+    X = np.asarray(X, dtype=dtype)
+    num_train, dim = X.shape
+    num_classes = np.max(y) + 1
+    upper = 1.0 / (2 * reg * num_train)
+    rng = np.random if seed is None else np.random.RandomState(seed)
+
+    signs = np.where(y[:, np.newaxis] == np.arange(num_classes), 1.0, -1.0)
+    alpha = np.zeros((num_train, num_classes))
+    row_sq_norms = np.einsum('ij,ij->i', X, X, dtype=np.float64)
+    # W is kept transposed so that the update of every example is contiguous.
+    W_T = np.zeros((num_classes, dim))
+
+    # Projected gradient bounds of the previous pass, used for shrinking.
+    pg_max_old = np.full(num_classes, np.inf)
+    pg_min_old = np.full(num_classes, -np.inf)
+    active = np.nonzero(row_sq_norms > 0)[0]
+    num_nonzero = len(active)
+    history = {'violation': [], 'active': [], 'time': []}
+    start = time.time()
+    for it in range(max_passes):
+      rng.shuffle(active)
+      keep = np.ones(len(active), dtype=bool)
+      pg_max = np.full(num_classes, -np.inf)
+      pg_min = np.full(num_classes, np.inf)
+      for pos, i in enumerate(active):
+        x = X[i]
+        s = signs[i]
+        a = alpha[i]
+        grad = W_T.dot(x)
+        grad *= s
+        grad -= 1
+        a_new = np.clip(a - grad / row_sq_norms[i], 0, upper)
+        step = a_new - a
+        # A variable that does not move is at a bound with the gradient
+        # pointing outwards, and its projected gradient is zero.
+        stuck = step == 0
+        if shrinking:
+          shrunk = stuck & ((grad > pg_max_old) | (grad < pg_min_old))
+          if shrunk.all():
+            keep[pos] = False
+            continue
+        pg = np.where(stuck, 0, grad)
+        np.maximum(pg_max, pg, out=pg_max)
+        np.minimum(pg_min, pg, out=pg_min)
+        if not stuck.all():
+          step *= s
+          W_T += np.outer(step, x)
+          alpha[i] = a_new
+
+      violation = float((pg_max - pg_min).max())
+      history['violation'].append(violation)
+      history['active'].append(len(active))
+      history['time'].append(time.time() - start)
+      if verbose:
+        print('pass %d / %d: violation %f, %d active examples' % (
+            it + 1, max_passes, violation, len(active)))
+
+      active = active[keep]
+      if violation <= tol:
+        if len(active) == num_nonzero:
+          break
+        # Converged on the active examples; check all of them again.
+        active = np.nonzero(row_sq_norms > 0)[0]
+        pg_max_old[:] = np.inf
+        pg_min_old[:] = -np.inf
+        continue
+      pg_max_old = np.where(pg_max <= 0, np.inf, pg_max)
+      pg_min_old = np.where(pg_min >= 0, -np.inf, pg_min)
+    else:
+      print('Warning: dual coordinate descent stopped after %d passes without '
+            'reaching tol %g; consider a larger max_passes' % (max_passes, tol))
+
+    self.W = np.ascontiguousarray(W_T.T, dtype=dtype)
+    return history
 
 
 class Softmax(LinearClassifier):
   """ A subclass that uses the Softmax + Cross-entropy loss function """
 
-  def loss(self, X_batch, y_batch, reg):
-    return softmax_loss_vectorized(self.W, X_batch, y_batch, reg)
+  def loss(self, X_batch, y_batch, reg, workspace=None):
+    return softmax_loss_vectorized(self.W, X_batch, y_batch, reg, workspace)
+
+
+class LinearClassifierGrid(object):
+  """
+  Train several linear classifiers with different (learning_rate, reg)
+  settings at once.
+
+  The weights of all R models are kept in one D x R x C array and every model
+  is trained on the same minibatches, so each iteration computes the scores
+  and the gradients of all models with one matrix multiplication each instead
+  of R thin ones. The wide products still grow with R, so the saving comes
+  from better use of BLAS and from sharing the minibatches, not from getting R
+  models for the price of one: a sweep over 20 settings of a CIFAR-10 SVM
+  costs about 7 times as much as one classifier, about a third of training
+  them one after another. Subclasses set the batched loss and the classifier
+  class returned by get_classifier.
+  """
+  classifier = None
+
+  def __init__(self, configs, dtype=None):
+    """
+    Inputs:
+    - configs: Sequence of (learning_rate, reg) pairs, for example
+      itertools.product(learning_rates, regularization_strengths).
+    - dtype: As for LinearClassifier.
+    """
+    self.configs = [tuple(config) for config in configs]
+    if len(self.configs) == 0:
+      raise ValueError('No (learning_rate, reg) pairs given')
+    self.learning_rates = np.array([lr for lr, _ in self.configs])
+    self.regs = np.array([reg for _, reg in self.configs])
+    self.W = None
+    self.dtype = dtype
+
+  compute_dtype = LinearClassifier.compute_dtype
+
+  def train(self, X, y, num_iters=100, batch_size=200, verbose=False,
+            sampling='random', seed=None):
+    """
+    Train all models with stochastic gradient descent on shared minibatches.
+
+    Inputs are the same as for LinearClassifier.train, without learning_rate
+    and reg, which are taken from the configurations.
+
+    Returns:
+    A dict mapping every (learning_rate, reg) pair to the list of its loss
+    values at each training iteration.
+    """
+    dtype = self.compute_dtype(X)
+    X = np.asarray(X, dtype=dtype)
+    num_train, dim = X.shape
+    num_classes = np.max(y) + 1
+    num_models = len(self.configs)
+    if self.W is None:
+      self.W = (0.001 * np.random.randn(dim, num_models, num_classes)).astype(dtype)
+    else:
+      self.W = self.W.astype(dtype, copy=False)
+
+    if sampling not in SAMPLING_MODES:
+      raise ValueError('Unknown sampling mode "%s"' % sampling)
+    sampler = None
+    if sampling != 'random':
+      sampler = MinibatchSampler(X, y, batch_size, sampling, seed)
+    workspace = {}
+    learning_rates = self.learning_rates.astype(dtype)[:, np.newaxis]
+
+    loss_history = np.zeros((num_iters, num_models))
+    for it in range(num_iters):
+      if sampler is not None:
+        X_batch, y_batch = sampler.next_batch()
+      else:
+        batch_idx = np.random.choice(num_train, batch_size, replace=True)
+        X_batch = X[batch_idx]
+        y_batch = y[batch_idx]
+
+      loss, grad = self.loss(X_batch, y_batch, self.regs, workspace)
+      loss_history[it] = loss
+
+      grad *= learning_rates
+      self.W -= grad
+
+      if verbose and it % 100 == 0:
+        print('iteration %d / %d: loss %f to %f' % (it, num_iters, loss.min(),
+                                                     loss.max()))
+
+    return dict(zip(self.configs, loss_history.T.tolist()))
+
+  def predict(self, X):
+    """
+    Predict labels for the data in X with every model.
+
+    Returns:
+    - y_pred: An integer array of shape (R, N); y_pred[r] are the labels
+      predicted by the model trained with configs[r].
+    """
+    dim, num_models, num_classes = self.W.shape
+    scores = X.dot(self.W.reshape(dim, -1))
+    return np.argmax(scores.reshape(-1, num_models, num_classes), axis=2).T
+
+  def accuracy(self, X, y):
+    """ dict mapping every (learning_rate, reg) pair to its accuracy on X, y """
+    accuracies = np.mean(self.predict(X) == y, axis=1)
+    return dict(zip(self.configs, accuracies.tolist()))
+
+  def get_classifier(self, config):
+    """ a trained classifier with a copy of the weights of the given pair """
+    clf = self.classifier(self.dtype)
+    clf.W = self.W[:, self.configs.index(tuple(config))].copy()
+    return clf
+
+  def loss(self, X_batch, y_batch, reg, workspace=None):
+    """
+    Compute the loss of every model and the gradient with respect to self.W.
+    Subclasses will override this.
+
+    Inputs are the same as for LinearClassifier.loss, except that reg is an
+    array of shape (R,).
+
+    Returns: A tuple containing:
+    - losses as an array of shape (R,)
+    - gradient with respect to self.W; an array of the same shape as W
+    """
+    pass
+
+
+class LinearSVMGrid(LinearClassifierGrid):
+  """ Train several LinearSVMs at once """
+  classifier = LinearSVM
+
+  def loss(self, X_batch, y_batch, reg, workspace=None):
+    return svm_loss_batched(self.W, X_batch, y_batch, reg, workspace)
+
+
+class SoftmaxGrid(LinearClassifierGrid):
+  """ Train several Softmax classifiers at once """
+  classifier = Softmax
+
+  def loss(self, X_batch, y_batch, reg, workspace=None):
+    return softmax_loss_batched(self.W, X_batch, y_batch, reg, workspace)
+
+
+def time_to_accuracy(history, target):
+  """
+  Seconds until the validation accuracy in a history returned by
+  train_lbfgs or compare_solvers first reached target, or None if it never
+  did.
+  """
+  for elapsed, accuracy in zip(history['time'], history['val_accuracy']):
+    if accuracy >= target:
+      return elapsed
+  return None
+
+
+def compare_solvers(classifier_class, X, y, X_val, y_val, reg,
+                    learning_rate=1e-7, num_iters=1500, batch_size=200,
+                    eval_every=100, max_iter=100, verbose=True, **lbfgs_kwargs):
+  """
+  Train classifier_class once with minibatch SGD and once with full-batch
+  L-BFGS from the same initial weights, recording the validation accuracy
+  over time, and report how quickly each reaches the best accuracy that both
+  reach.
+
+  Inputs:
+  - classifier_class: LinearSVM or Softmax.
+  - X, y, X_val, y_val: Training and validation data and labels.
+  - reg: Regularization strength of both solvers.
+  - learning_rate, num_iters, batch_size: SGD parameters, as for train.
+  - eval_every: Number of SGD iterations between validation evaluations.
+  - max_iter, lbfgs_kwargs: L-BFGS parameters, as for train_lbfgs.
+  - verbose: Boolean; if true, print the comparison.
+
+  Returns:
+  A dictionary mapping 'sgd' and 'lbfgs' to a history dictionary of lists
+  'time' and 'val_accuracy', as returned by train_lbfgs.
+  """
+  W0 = 0.001 * np.random.randn(X.shape[1], np.max(y) + 1)
+
+  sgd = classifier_class()
+  sgd.W = W0.copy()
+  sgd_history = {'time': [], 'val_accuracy': []}
+  start = time.time()
+  for it in range(0, num_iters, eval_every):
+    sgd.train(X, y, learning_rate, reg, min(eval_every, num_iters - it),
+              batch_size)
+    sgd_history['time'].append(time.time() - start)
+    sgd_history['val_accuracy'].append(float(np.mean(sgd.predict(X_val) == y_val)))
+
+  lbfgs = classifier_class()
+  lbfgs.W = W0.copy()
+  lbfgs_history = lbfgs.train_lbfgs(X, y, reg, max_iter=max_iter, X_val=X_val,
+                                    y_val=y_val, **lbfgs_kwargs)
+
+  histories = {'sgd': sgd_history, 'lbfgs': lbfgs_history}
+  if verbose:
+    target = min(max(h['val_accuracy']) for h in histories.values())
+    for name, history in sorted(histories.items()):
+      print('%s: best val accuracy %f, reached %f after %.2fs (total %.2fs)' % (
+          name, max(history['val_accuracy']), target,
+          time_to_accuracy(history, target), history['time'][-1]))
+  return histories
@@ -1,6 +1,8 @@
 import numpy as np
 from random import shuffle
 
+from cs682.classifiers.workspace import correct_class_index, workspace_buffer
+
 def svm_loss_naive(W, X, y, reg):
   """
   Structured SVM loss function, naive implementation (with loops).
@@ -66,15 +68,25 @@ def svm_loss_naive(W, X, y, reg):
   return loss, dW
 
 
-def svm_loss_vectorized(W, X, y, reg):
+def svm_loss_vectorized(W, X, y, reg, workspace=None, smoothing=0.0):
   """
   Structured SVM loss function, vectorized implementation.
 
-  Inputs and outputs are the same as svm_loss_naive.
+  Inputs and outputs are the same as svm_loss_naive. The scores, margins and
+  the gradient are computed in the common type of W and X, so float32 inputs
+  give a float32 gradient; the loss is summed in float64.
+
+  - workspace: Optional dict in which the N x C and D x C temporaries are
+    kept between calls, as LinearClassifier.train does; with it a call
+    allocates nothing but the returned gradient.
+  - smoothing: If positive, replace the hinge max(0, m) of every margin m by
+    the quadratically smoothed hinge that is m^2 / (2 * smoothing) for
+    0 <= m <= smoothing and m - smoothing / 2 above, which has a continuous
+    gradient as needed by LinearClassifier.train_lbfgs.
   """
-  loss = 0.0
-  dW = np.zeros(W.shape) # initialize the gradient as zero (3073*10)
-
+  if workspace is None:
+    workspace = {}
+  dtype = np.result_type(X.dtype, W.dtype)
   num_classes = W.shape[1]
   num_train = X.shape[0]
   #############################################################################
@@ -82,14 +94,35 @@ def svm_loss_vectorized(W, X, y, reg):
   # Implement a vectorized version of the structured SVM loss, storing the    #
   # result in loss.                                                           #
   #############################################################################
-  scores = X.dot(W)  # (500*3073) X (3073*10) = (500*10)
-  actuals = scores[np.arange(num_train), y] # (500*1)
-  diffs = scores.T - actuals + 1 #(10*500)   
-  diffs[np.where(diffs < 0)] = 0
-  diffSum = np.sum(diffs)
-  loss = (diffSum - num_train)/num_train #Subtracting the difference of 1 from each example for its own class.
+  margins = workspace_buffer(workspace, 'scores', (num_train, num_classes), dtype)
+  np.dot(X, W, out=margins)
+  correct = correct_class_index(workspace, y, num_classes)
+  correct_scores = workspace_buffer(workspace, 'correct_scores', (num_train,),
+                                    dtype)
+  np.take(margins.reshape(-1), correct, out=correct_scores, mode='clip')
+  margins -= correct_scores[:, np.newaxis]
+  margins += 1 # note delta = 1
+
+  # Only positive margins of the incorrect classes count.
+  positive = workspace_buffer(workspace, 'positive', margins.shape, bool)
+  np.greater(margins, 0, out=positive)
+  np.put(positive, correct, False)
+  margins *= positive
+  if smoothing > 0:
+    # The derivative of the smoothed hinge is min(m / smoothing, 1), and its
+    # value is m * slope - smoothing / 2 * slope^2.
+    slopes = workspace_buffer(workspace, 'slopes', margins.shape, dtype)
+    np.multiply(margins, 1.0 / smoothing, out=slopes)
+    np.minimum(slopes, 1, out=slopes)
+    loss = (np.vdot(slopes, margins) - 0.5 * smoothing * np.vdot(slopes, slopes))
+    loss = float(loss) / num_train
+  else:
+    loss = np.sum(margins, dtype=np.float64) / num_train
+
   # Add regularization to the loss.
-  loss += reg * np.sum(W * W)
+  reg_term = workspace_buffer(workspace, 'reg_term', W.shape, W.dtype)
+  np.multiply(W, W, out=reg_term)
+  loss += reg * np.sum(reg_term, dtype=np.float64)
 
   #############################################################################
   #                             END OF YOUR CODE                              #
@@ -105,18 +138,77 @@ def svm_loss_vectorized(W, X, y, reg):
   # to reuse some of the intermediate values that you used to compute the     #
   # loss.                                                                     #
   #############################################################################
-  diffs[np.where(diffs == 1)] = -1 
-  diffs[np.where(diffs > 0)] = 1 #(10*500)
-  diffs[np.where(diffs == -1)] = 0
-  margin_counts = np.sum(diffs, axis = 0) #(500*1)
-  diffs[y, np.arange(num_train)] = -1 * margin_counts.T
-  dW = X.T.dot(diffs.T)
+  # Every positive margin adds X[i] to its class column and subtracts it from
+  # the correct class column, scaled by the slope of the smoothed hinge.
+  if smoothing > 0:
+    coeffs = slopes
+  else:
+    coeffs = margins
+    np.copyto(coeffs, positive)
+  margin_counts = workspace_buffer(workspace, 'margin_counts', (num_train,),
+                                   dtype)
+  np.sum(coeffs, axis=1, out=margin_counts)
+  np.negative(margin_counts, out=margin_counts)
+  np.put(coeffs, correct, margin_counts)
+  dW = X.T.dot(coeffs)
 
   dW /= num_train
-  dW += 2 * reg * W
-  
+  np.multiply(W, 2 * reg, out=reg_term)
+  dW += reg_term
+
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
 
   return loss, dW
+
+
+def svm_loss_batched(W, X, y, reg, workspace=None):
+  """
+  Structured SVM loss of R models that share a minibatch, with the scores and
+  the gradient of all models computed by one matrix multiplication each.
+
+  Inputs:
+  - W: A numpy array of shape (D, R, C) containing the weights of R models.
+  - X, y: As for svm_loss_naive.
+  - reg: A numpy array of shape (R,) with the regularization strength of
+    every model.
+  - workspace: As for svm_loss_vectorized.
+
+  Returns a tuple of:
+  - loss of every model as a numpy array of shape (R,)
+  - gradient with respect to W; an array of shape (D, R, C)
+  """
+  if workspace is None:
+    workspace = {}
+  dtype = np.result_type(X.dtype, W.dtype)
+  dim, num_models, num_classes = W.shape
+  num_train = X.shape[0]
+  rows = np.arange(num_train)
+
+  scores = workspace_buffer(workspace, 'scores',
+                            (num_train, num_models * num_classes), dtype)
+  np.dot(X, W.reshape(dim, -1), out=scores)
+  margins = scores.reshape(num_train, num_models, num_classes)
+  margins -= margins[rows, :, y][:, :, np.newaxis]
+  margins += 1 # note delta = 1
+
+  # Only positive margins of the incorrect classes count.
+  positive = workspace_buffer(workspace, 'positive', margins.shape, bool)
+  np.greater(margins, 0, out=positive)
+  positive[rows, :, y] = False
+  margins *= positive
+  reg = np.asarray(reg)
+  loss = margins.sum(axis=(0, 2), dtype=np.float64) / num_train
+  loss += reg * np.einsum('drc,drc->r', W, W, dtype=np.float64)
+
+  # Every positive margin adds X[i] to its class column and subtracts it from
+  # the correct class column.
+  coeffs = margins
+  np.copyto(coeffs, positive)
+  coeffs[rows, :, y] = -coeffs.sum(axis=2)
+  dW = X.T.dot(scores).reshape(W.shape)
+  dW /= num_train
+  dW += (2 * reg.astype(dtype))[:, np.newaxis] * W
+
+  return loss, dW
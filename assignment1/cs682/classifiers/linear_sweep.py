@@ -0,0 +1,144 @@
+from __future__ import print_function
+
+import multiprocessing
+from collections import namedtuple
+
+import numpy as np
+
+from cs682.shared_array import attach_array, release_shared, share_array
+
+# Outcome of training one classifier of a sweep.
+SweepResult = namedtuple('SweepResult', ['learning_rate', 'reg',
+                                         'train_accuracy', 'val_accuracy',
+                                         'loss_history', 'W'])
+
+# Shared data arrays attached by each worker of a parallel sweep.
+_sweep_arrays = {}
+
+
+def _attach_sweep_data(specs):
+  """ pool initializer: attach the shared training and validation data """
+  for name, spec in specs.items():
+    _sweep_arrays[name] = attach_array(spec)
+
+
+def _train_config(classifier_class, dtype, learning_rate, reg, seed,
+                  train_kwargs, X_train, y_train, X_val, y_val):
+  """ train one classifier and evaluate it on the training and validation data """
+  # LinearClassifier.train draws from the global random state; seed it for
+  # this run only, so a serial sweep leaves the caller's state untouched.
+  state = np.random.get_state()
+  np.random.seed(seed)
+  try:
+    clf = classifier_class(dtype)
+    loss_history = clf.train(X_train, y_train, learning_rate=learning_rate,
+                             reg=reg, **train_kwargs)
+  finally:
+    np.random.set_state(state)
+  train_accuracy = float(np.mean(clf.predict(X_train) == y_train))
+  val_accuracy = float(np.mean(clf.predict(X_val) == y_val))
+  return SweepResult(learning_rate, reg, train_accuracy, val_accuracy,
+                     loss_history, clf.W)
+
+
+def _sweep_task(args):
+  """ pool task: train one configuration on the shared data """
+  arrays = [_sweep_arrays[name][1]
+            for name in ('X_train', 'y_train', 'X_val', 'y_val')]
+  return _train_config(*(tuple(args) + tuple(arrays)))
+
+
+def iter_sweep(classifier_class, configs, X_train, y_train, X_val, y_val,
+               n_jobs=None, dtype=None, seed=None, **train_kwargs):
+  """
+  Train one classifier per (learning_rate, reg) pair and yield the results as
+  the runs finish.
+
+  With n_jobs greater than 1 the runs are spread over a pool of worker
+  processes. X_train, y_train, X_val and y_val are copied once into shared
+  memory, which every worker attaches to, instead of being pickled for every
+  run. Each worker may also start its own BLAS threads; for the best
+  throughput limit BLAS to one thread per process (e.g. OMP_NUM_THREADS=1).
+
+  Every run seeds numpy's global random state with seed plus its position in
+  configs, so the results do not depend on n_jobs or on the order in which the
+  runs finish. The caller's random state is restored after each run.
+
+  Inputs:
+  - classifier_class: LinearSVM, Softmax or another LinearClassifier subclass.
+  - configs: Sequence of (learning_rate, reg) pairs.
+  - X_train, y_train, X_val, y_val: Training and validation data and labels.
+  - n_jobs: Number of worker processes; if None or 1, run in this process.
+  - dtype: As for LinearClassifier.
+  - seed: Base seed of the runs; if None, it is drawn from numpy's global
+    random state.
+  - train_kwargs: Further arguments of LinearClassifier.train, such as
+    num_iters or batch_size.
+
+  Yields:
+  A SweepResult for every configuration, in the order the runs finish.
+  """
+  configs = [tuple(config) for config in configs]
+  if seed is None:
+    seed = np.random.randint(2 ** 31 - len(configs))
+  tasks = [(classifier_class, dtype, lr, reg, seed + i, train_kwargs)
+           for i, (lr, reg) in enumerate(configs)]
+
+  if n_jobs is None or n_jobs <= 1:
+    for task in tasks:
+      yield _train_config(*(task + (X_train, y_train, X_val, y_val)))
+    return
+
+  shms, specs = [], {}
+  try:
+    for name, arr in (('X_train', X_train), ('y_train', y_train),
+                      ('X_val', X_val), ('y_val', y_val)):
+      shm, specs[name] = share_array(np.asarray(arr))
+      shms.append(shm)
+    pool = multiprocessing.Pool(min(n_jobs, len(tasks)),
+                                initializer=_attach_sweep_data,
+                                initargs=(specs,))
+    try:
+      for result in pool.imap_unordered(_sweep_task, tasks):
+        yield result
+    finally:
+      pool.terminate()
+      pool.join()
+  finally:
+    release_shared(*shms)
+
+
+def sweep(classifier_class, configs, X_train, y_train, X_val, y_val,
+          n_jobs=None, dtype=None, seed=None, verbose=False, **train_kwargs):
+  """
+  Train one classifier per (learning_rate, reg) pair, possibly in parallel,
+  and keep the one with the best validation accuracy. Only the weights of the
+  best classifier so far are kept while the results stream in.
+
+  Inputs are the same as for iter_sweep, plus:
+  - verbose: Boolean; if true, print every result as its run finishes.
+
+  Returns a tuple of:
+  - results: A dictionary mapping every (learning_rate, reg) pair to a tuple
+    (training accuracy, validation accuracy).
+  - best_val: The highest validation accuracy.
+  - best_classifier: A classifier_class instance with the weights of the run
+    that achieved best_val.
+  """
+  configs = [tuple(config) for config in configs]
+  results = {}
+  best_val, best_classifier = -1, None
+  for result in iter_sweep(classifier_class, configs, X_train, y_train, X_val,
+                           y_val, n_jobs=n_jobs, dtype=dtype, seed=seed,
+                           **train_kwargs):
+    results[result.learning_rate, result.reg] = (result.train_accuracy,
+                                                 result.val_accuracy)
+    if verbose:
+      print('lr %e reg %e train accuracy: %f val accuracy: %f (%d / %d)' % (
+          result.learning_rate, result.reg, result.train_accuracy,
+          result.val_accuracy, len(results), len(configs)))
+    if result.val_accuracy > best_val:
+      best_val = result.val_accuracy
+      best_classifier = classifier_class(dtype)
+      best_classifier.W = result.W
+  return results, best_val, best_classifier
@@ -2,6 +2,8 @@ import numpy as np
 import math
 from random import shuffle
 
+from cs682.classifiers.workspace import correct_class_index, workspace_buffer
+
 def softmax_loss_naive(W, X, y, reg):
   """
   Softmax loss function, naive implementation (with loops)
@@ -71,15 +73,22 @@ def softmax_loss_naive(W, X, y, reg):
   return loss, dW
 
 
-def softmax_loss_vectorized(W, X, y, reg):
+def softmax_loss_vectorized(W, X, y, reg, workspace=None):
   """
   Softmax loss function, vectorized version.
 
-  Inputs and outputs are the same as softmax_loss_naive.
+  Inputs and outputs are the same as softmax_loss_naive. The scores,
+  probabilities and the gradient are computed in the common type of W and X,
+  so float32 inputs give a float32 gradient; the loss is summed in float64.
+
+  - workspace: Optional dict in which the N x C and D x C temporaries are
+    kept between calls, as LinearClassifier.train does; with it a call
+    allocates nothing but the returned gradient.
   """
-  # Initialize the loss and gradient to zero.
-  loss = 0.0
-  dW = np.zeros_like(W)
+  if workspace is None:
+    workspace = {}
+  dtype = np.result_type(X.dtype, W.dtype)
+  num_classes = W.shape[1]
   num_train = X.shape[0]
 
   #############################################################################
@@ -88,30 +97,79 @@ def softmax_loss_vectorized(W, X, y, reg):
   # here, it is easy to run into numeric instability. Don't forget the        #
   # regularization!                                                           #
   #############################################################################
-  scores = X.dot(W)
+  scores = workspace_buffer(workspace, 'scores', (num_train, num_classes), dtype)
+  np.dot(X, W, out=scores)
   #To remove numeric instability where there is a possibility of overflow,
-  #we subtract maximum of the scores from each row
-  scores = scores - np.max(scores) 
-  scores_e = np.exp(scores) #500*10
-  actuals = scores_e[np.arange(num_train), y] # (500*1)
-  scores_sum = np.sum(scores_e, axis = 1) #500*1
-  ratios = np.log(np.divide(actuals, scores_sum))
-  loss = -1 * np.sum(ratios)
-  loss = loss/num_train
+  #we subtract the maximum score of each row
+  row_values = workspace_buffer(workspace, 'row_values', (num_train,), dtype)
+  np.max(scores, axis=1, out=row_values)
+  scores -= row_values[:, np.newaxis]
+  np.exp(scores, out=scores)
+  np.sum(scores, axis=1, out=row_values)
+  probs = scores
+  probs /= row_values[:, np.newaxis]
+
+  correct = correct_class_index(workspace, y, num_classes)
+  correct_probs = workspace_buffer(workspace, 'correct_probs', (num_train,),
+                                   dtype)
+  np.take(probs.reshape(-1), correct, out=correct_probs, mode='clip')
+  # The gradient of the scores is probs minus one at the correct class.
+  np.subtract(correct_probs, 1, out=row_values)
+  np.put(probs, correct, row_values)
+
+  np.log(correct_probs, out=correct_probs)
+  loss = -1 * np.sum(correct_probs, dtype=np.float64) / num_train
   # Add regularization to the loss.
-  loss += reg * np.sum(W * W)
-
+  reg_term = workspace_buffer(workspace, 'reg_term', W.shape, W.dtype)
+  np.multiply(W, W, out=reg_term)
+  loss += reg * np.sum(reg_term, dtype=np.float64)
 
-  scores_divided = (np.divide(scores_e.T, scores_sum)).T
-  scores_divided[np.arange(num_train), y] -= 1
-  dW = X.T.dot(scores_divided)
-  dW = dW/num_train
+  dW = X.T.dot(probs)
+  dW /= num_train
   #Adding regularization to dW
-  dW += 2 * reg * W
-  
+  np.multiply(W, 2 * reg, out=reg_term)
+  dW += reg_term
+
   #############################################################################
   #                          END OF YOUR CODE                                 #
   #############################################################################
 
   return loss, dW
 
+
+def softmax_loss_batched(W, X, y, reg, workspace=None):
+  """
+  Softmax loss of R models that share a minibatch, with the scores and the
+  gradient of all models computed by one matrix multiplication each.
+
+  Inputs and outputs are the same as svm_loss_batched.
+  """
+  if workspace is None:
+    workspace = {}
+  dtype = np.result_type(X.dtype, W.dtype)
+  dim, num_models, num_classes = W.shape
+  num_train = X.shape[0]
+  rows = np.arange(num_train)
+
+  scores = workspace_buffer(workspace, 'scores',
+                            (num_train, num_models * num_classes), dtype)
+  np.dot(X, W.reshape(dim, -1), out=scores)
+  probs = scores.reshape(num_train, num_models, num_classes)
+  #To remove numeric instability where there is a possibility of overflow,
+  #we subtract the maximum score of each row
+  probs -= probs.max(axis=2)[:, :, np.newaxis]
+  np.exp(probs, out=probs)
+  probs /= probs.sum(axis=2)[:, :, np.newaxis]
+
+  correct_probs = probs[rows, :, y]
+  # The gradient of the scores is probs minus one at the correct class.
+  probs[rows, :, y] -= 1
+  reg = np.asarray(reg)
+  loss = -np.log(correct_probs).sum(axis=0, dtype=np.float64) / num_train
+  loss += reg * np.einsum('drc,drc->r', W, W, dtype=np.float64)
+
+  dW = X.T.dot(scores).reshape(W.shape)
+  dW /= num_train
+  dW += (2 * reg.astype(dtype))[:, np.newaxis] * W
+
+  return loss, dW
@@ -0,0 +1,34 @@
+import numpy as np
+
+
+def workspace_buffer(workspace, name, shape, dtype=np.float64):
+  """
+  Return an uninitialized array of the given shape and dtype from a workspace
+  dict, allocating it only when the workspace holds no suitable buffer yet.
+
+  A buffer with at least shape[0] rows is reused and a view of its first
+  shape[0] rows returned, so a smaller last minibatch does not reallocate.
+  The view is C-contiguous and can be passed as out= to numpy functions.
+  """
+  dtype = np.dtype(dtype)
+  buf = workspace.get(name)
+  if (buf is None or buf.dtype != dtype or buf.shape[1:] != tuple(shape[1:])
+      or buf.shape[0] < shape[0]):
+    buf = np.empty(shape, dtype=dtype)
+    workspace[name] = buf
+  return buf[:shape[0]]
+
+
+def correct_class_index(workspace, y, num_classes):
+  """
+  Flat indices y[i] + i * num_classes of the correct class scores in a
+  C-contiguous N x num_classes matrix, computed into a workspace buffer.
+  """
+  num_train = y.shape[0]
+  rows = workspace.get('rows')
+  if rows is None or rows.shape[0] < num_train:
+    rows = workspace['rows'] = np.arange(num_train)
+  flat = workspace_buffer(workspace, 'correct_index', (num_train,), np.intp)
+  np.multiply(rows[:num_train], num_classes, out=flat)
+  flat += y
+  return flat
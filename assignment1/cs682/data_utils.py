@@ -40,6 +40,20 @@ def load_CIFAR10(ROOT):
   return Xtr, Ytr, Xte, Yte
 
 
+def iter_CIFAR10_batches(ROOT, train=True):
+  """
+  Yield the (X, Y) pairs of the CIFAR-10 batch files one at a time, so that a
+  consumer such as cs682.features.iter_features only ever holds one batch of
+  10000 images in memory.
+  """
+  if train:
+    names = ['data_batch_%d' % b for b in range(1, 6)]
+  else:
+    names = ['test_batch']
+  for name in names:
+    yield load_CIFAR_batch(os.path.join(ROOT, name))
+
+
 def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
                      subtract_mean=True):
     """
@@ -207,6 +221,45 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
   }
 
 
+def iter_tiny_imagenet_train(path, chunk_size=1000, dtype=np.float32):
+  """
+  Stream the training images of a TinyImageNet directory in chunks instead of
+  loading them all like load_tiny_imagenet does.
+
+  Inputs:
+  - path: String giving path to the directory to load.
+  - chunk_size: Maximum number of images per chunk.
+  - dtype: numpy datatype used to load the data.
+
+  Yields:
+  Tuples (X, y) where X is a (N_i, 64, 64, 3) array of images, in the height x
+  width x channel layout the feature functions expect, and y the (N_i,) array
+  of their labels.
+  """
+  with open(os.path.join(path, 'wnids.txt'), 'r') as f:
+    wnids = [x.strip() for x in f]
+
+  files, labels = [], []
+  for i, wnid in enumerate(wnids):
+    boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
+    with open(boxes_file, 'r') as f:
+      for x in f:
+        files.append(os.path.join(path, 'train', wnid, 'images',
+                                  x.split('\t')[0]))
+        labels.append(i)
+
+  for start in range(0, len(files), chunk_size):
+    chunk = files[start:start + chunk_size]
+    X = np.zeros((len(chunk), 64, 64, 3), dtype=dtype)
+    for j, img_file in enumerate(chunk):
+      img = imread(img_file)
+      if img.ndim == 2:
+        ## grayscale file
+        img = img[:, :, np.newaxis]
+      X[j] = img
+    yield X, np.array(labels[start:start + chunk_size], dtype=np.int64)
+
+
 def load_models(models_dir):
   """
   Load saved models from disk. This will attempt to unpickle all files in a
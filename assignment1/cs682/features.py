@@ -1,11 +1,21 @@
 from __future__ import print_function
 
+import functools
+import hashlib
+import multiprocessing
+import os
+
 import matplotlib
 import numpy as np
-from scipy.ndimage import uniform_filter
+
+from cs682.shared_array import attach_array, empty_shared, release_shared
+
+# Number of images handed to a batched feature function at once.
+FEATURE_BATCH_SIZE = 1000
 
 
-def extract_features(imgs, feature_fns, verbose=False):
+def extract_features(imgs, feature_fns, verbose=False, n_jobs=None,
+                     cache_dir=None, cache_key=None):
   """
   Given pixel data for images and several feature functions that can operate on
   single images, apply all feature functions to all images, concatenating the
@@ -18,6 +28,21 @@ def extract_features(imgs, feature_fns, verbose=False):
     take as input an H x W x D array and return a (one-dimensional) array of
     length F_i.
   - verbose: Boolean; if true, print progress.
+  - n_jobs: If greater than 1, split the images into chunks and extract them
+    in this many worker processes, which write straight into a shared-memory
+    output matrix. imgs and feature_fns are handed to the workers when they
+    start; with the default fork start method on Linux this copies nothing
+    and lambdas work, while other start methods need picklable functions.
+  - cache_dir: If given, the features of every feature function are stored in
+    this directory as a .npy file named after a hash of imgs and a hash of
+    the function and its parameters (see feature_fn_key), and loaded from
+    there on later calls. Only the feature functions without a cached block
+    are computed, so changing e.g. nbin of color_histogram_hsv only
+    recomputes the color histograms.
+  - cache_key: Optional string identifying imgs in the cache, such as
+    'cifar10-train'. Hashing a large imgs array takes about a second per GB,
+    so passing a key makes fully cached calls nearly free; the caller is then
+    responsible for changing the key whenever imgs changes.
 
   Returns:
   An array of shape (N, F_1 + ... + F_k) where each column is the concatenation
@@ -27,34 +52,372 @@ def extract_features(imgs, feature_fns, verbose=False):
   if num_images == 0:
     return np.array([])
 
+  if cache_dir is not None:
+    return _extract_features_cached(imgs, feature_fns, verbose, n_jobs,
+                                    cache_dir, cache_key)
+
   # Use the first image to determine feature dimensions
   feature_dims = []
-  first_image_features = []
   for feature_fn in feature_fns:
     feats = feature_fn(imgs[0].squeeze())
     assert len(feats.shape) == 1, 'Feature functions must be one-dimensional'
     feature_dims.append(feats.size)
-    first_image_features.append(feats)
 
   # Now that we know the dimensions of the features, we can allocate a single
   # big array to store all features as columns.
   total_feature_dim = sum(feature_dims)
-  imgs_features = np.zeros((num_images, total_feature_dim))
-  imgs_features[0] = np.hstack(first_image_features).T
-
-  # Extract features for the rest of the images.
-  for i in range(1, num_images):
-    idx = 0
-    for feature_fn, feature_dim in zip(feature_fns, feature_dims):
-      next_idx = idx + feature_dim
-      imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
-      idx = next_idx
-    if verbose and i % 1000 == 0:
-      print('Done extracting features for %d / %d images' % (i, num_images))
 
+  if n_jobs is None or n_jobs <= 1:
+    imgs_features = np.zeros((num_images, total_feature_dim))
+    for start in range(0, num_images, FEATURE_BATCH_SIZE):
+      stop = min(start + FEATURE_BATCH_SIZE, num_images)
+      _extract_chunk(imgs, imgs_features, start, stop, feature_fns,
+                     feature_dims)
+      if verbose:
+        print('Done extracting features for %d / %d images' % (stop, num_images))
+    return imgs_features
+
+  # Smaller chunks than FEATURE_BATCH_SIZE keep all workers busy until the end.
+  chunk = int(min(FEATURE_BATCH_SIZE, np.ceil(num_images / (4.0 * n_jobs))))
+  chunks = [(start, min(start + chunk, num_images))
+            for start in range(0, num_images, chunk)]
+  out_shm, out_spec, shared_features = empty_shared((num_images,
+                                                     total_feature_dim))
+  try:
+    pool = multiprocessing.Pool(
+        n_jobs, initializer=_start_feature_worker,
+        initargs=(imgs, out_spec, feature_fns, feature_dims))
+    try:
+      done = 0
+      for start, stop in pool.imap_unordered(_extract_shared_chunk, chunks):
+        done += stop - start
+        if verbose:
+          print('Done extracting features for %d / %d images' % (done, num_images))
+    finally:
+      pool.close()
+      pool.join()
+    imgs_features = np.array(shared_features)
+  finally:
+    del shared_features
+    release_shared(out_shm)
   return imgs_features
 
 
+def _extract_features_cached(imgs, feature_fns, verbose, n_jobs, cache_dir,
+                             cache_key):
+  """ extract_features backed by the per-function block cache in cache_dir """
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  data_key = cache_key or array_key(imgs)
+
+  blocks = []
+  for feature_fn in feature_fns:
+    path = os.path.join(cache_dir, '%s-%s.npy' % (data_key,
+                                                  feature_fn_key(feature_fn)))
+    if os.path.exists(path):
+      if verbose:
+        print('Loading cached features from %s' % path)
+      block = np.load(path, mmap_mode='r')
+    else:
+      block = extract_features(imgs, [feature_fn], verbose, n_jobs)
+      # Write to a temporary name first so an interrupted run never leaves a
+      # truncated block behind.
+      tmp_path = path[:-len('.npy')] + '.%d.tmp.npy' % os.getpid()
+      np.save(tmp_path, block)
+      os.rename(tmp_path, path)
+    blocks.append(block)
+  return np.hstack(blocks)
+
+
+def array_key(arr):
+  """ hex digest identifying the shape, dtype and contents of a numpy array """
+  h = hashlib.sha1()
+  h.update(repr((arr.shape, arr.dtype.str)).encode())
+  # Hash in slices along the first axis so non-contiguous arrays are never
+  # copied as a whole.
+  step = max(1, (64 * 1024 ** 2) // max(1, arr[:1].nbytes))
+  for start in range(0, arr.shape[0], step):
+    h.update(np.ascontiguousarray(arr[start:start + step]).data)
+  return h.hexdigest()[:20]
+
+
+def feature_fn_key(feature_fn):
+  """
+  Name plus hex digest identifying a feature function and its parameters:
+  the arguments bound by functools.partial, default argument values, and for
+  lambdas and closures their code, captured variables and the values of the
+  plain (number, string or tuple) globals they read. Changing what such a
+  function calls internally, e.g. editing hog_feature itself, is not
+  detected; clear the cache directory in that case.
+  """
+  if isinstance(feature_fn, FeaturePipeline):
+    steps = '+'.join(feature_fn_key(step) for step in feature_fn.steps)
+    return 'pipeline-%s' % hashlib.sha1(steps.encode()).hexdigest()[:12]
+
+  h = hashlib.sha1()
+  fn = feature_fn
+  while isinstance(fn, functools.partial):
+    h.update(repr((fn.args, sorted((fn.keywords or {}).items()))).encode())
+    fn = fn.func
+  name = getattr(fn, '__name__', type(fn).__name__)
+  h.update(('%s.%s' % (getattr(fn, '__module__', ''),
+                       getattr(fn, '__qualname__', name))).encode())
+  h.update(repr((getattr(fn, '__defaults__', None),
+                 getattr(fn, '__kwdefaults__', None))).encode())
+  code = getattr(fn, '__code__', None)
+  if code is not None and (name == '<lambda>' or fn.__closure__):
+    h.update(code.co_code)
+    h.update(repr(code.co_consts).encode())
+    h.update(repr(code.co_names).encode())
+    h.update(repr([c.cell_contents for c in fn.__closure__ or ()]).encode())
+    # Plain values of the globals it reads, e.g. num_color_bins in
+    # lambda img: color_histogram_hsv(img, nbin=num_color_bins).
+    for global_name in code.co_names:
+      value = fn.__globals__.get(global_name)
+      if isinstance(value, (bool, int, float, str, tuple)):
+        h.update(repr((global_name, value)).encode())
+  if name == '<lambda>':
+    name = 'lambda'
+  return '%s-%s' % (name, h.hexdigest()[:12])
+
+
+def _extract_chunk(imgs, imgs_features, start, stop, feature_fns, feature_dims):
+  """
+  Fill rows start:stop of imgs_features. Feature functions with a batched
+  version in BATCH_FEATURE_FNS process the whole chunk in one call; the others
+  run image by image.
+  """
+  idx = 0
+  for feature_fn, feature_dim in zip(feature_fns, feature_dims):
+    next_idx = idx + feature_dim
+    batch_fn = batch_feature_fn(feature_fn)
+    if batch_fn is not None:
+      imgs_features[start:stop, idx:next_idx] = batch_fn(imgs[start:stop])
+    else:
+      for i in range(start, stop):
+        imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
+    idx = next_idx
+
+
+# State of a feature extraction worker process, set by _start_feature_worker.
+_feature_worker = {}
+
+
+def _start_feature_worker(imgs, out_spec, feature_fns, feature_dims):
+  """ pool initializer: attach the shared output matrix once per worker """
+  _feature_worker['imgs'] = imgs
+  _feature_worker['out'] = attach_array(out_spec)
+  _feature_worker['feature_fns'] = feature_fns
+  _feature_worker['feature_dims'] = feature_dims
+
+
+def _extract_shared_chunk(bounds):
+  """ pool task: extract one chunk of images into the shared output matrix """
+  start, stop = bounds
+  _extract_chunk(_feature_worker['imgs'], _feature_worker['out'][1], start,
+                 stop, _feature_worker['feature_fns'],
+                 _feature_worker['feature_dims'])
+  return start, stop
+
+
+def iter_array_chunks(arr, chunk_size=FEATURE_BATCH_SIZE):
+  """
+  Yield consecutive chunks of chunk_size rows of arr. For a memory-mapped arr,
+  e.g. from np.load(path, mmap_mode='r'), only one chunk is read at a time.
+  """
+  for start in range(0, arr.shape[0], chunk_size):
+    yield np.asarray(arr[start:start + chunk_size])
+
+
+def iter_features(chunks, feature_fns, n_jobs=None):
+  """
+  Streaming version of extract_features: compute the features of every chunk
+  of images from an iterable and yield them chunk by chunk, so that only one
+  chunk of images and of features is in memory at a time.
+
+  Inputs:
+  - chunks: Iterable of N_i x H x W x C arrays of pixel data, such as
+    iter_array_chunks of a memmap or the images of
+    cs682.data_utils.iter_CIFAR10_batches.
+  - feature_fns, n_jobs: As for extract_features.
+
+  Yields:
+  Arrays of shape (N_i, F_1 + ... + F_k), one per chunk.
+  """
+  for imgs in chunks:
+    if imgs.shape[0] > 0:
+      yield extract_features(imgs, feature_fns, n_jobs=n_jobs)
+
+
+def extract_features_to(chunks, feature_fns, out, verbose=False, n_jobs=None):
+  """
+  Compute the features of a stream of image chunks into a preallocated array,
+  typically a memmap created with np.lib.format.open_memmap, so that datasets
+  larger than memory can be processed in bounded memory.
+
+  Inputs:
+  - chunks, feature_fns, n_jobs: As for iter_features.
+  - out: Array of shape (N, F_1 + ... + F_k) with N at least the total number
+    of images; the features of the ith image are written to out[i].
+  - verbose: Boolean; if true, print progress after every chunk.
+
+  Returns:
+  The number of rows of out that were written.
+  """
+  num_done = 0
+  for feats in iter_features(chunks, feature_fns, n_jobs=n_jobs):
+    stop = num_done + feats.shape[0]
+    if stop > out.shape[0]:
+      raise ValueError('Output has room for %d images but more were given'
+                       % out.shape[0])
+    out[num_done:stop] = feats
+    num_done = stop
+    if verbose:
+      print('Done extracting features for %d images' % num_done)
+  if hasattr(out, 'flush'):
+    out.flush()
+  return num_done
+
+
+class FeatureStandardizer(object):
+  """
+  Standardize features to zero mean and unit variance, like subtracting
+  np.mean(X, axis=0) and dividing by np.std(X, axis=0), without full float64
+  copies of the feature matrix.
+
+  The statistics are accumulated chunk by chunk in one pass (merging the
+  per-chunk means and squared deviations as in Welford's algorithm), so fit
+  works on memmaps and partial_fit on streams such as iter_features. transform
+  works chunk by chunk as well and can write in place. Columns with zero
+  variance are only centered.
+
+  The fitted statistics can be stored with save, e.g. next to the feature
+  cache of extract_features, and restored with FeatureStandardizer.load.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.mean = None
+    self.m2 = None
+
+  def partial_fit(self, X):
+    """ update the statistics with an N x D chunk of features; returns self """
+    X = np.asarray(X)
+    if X.shape[0] == 0:
+      return self
+    chunk_count = X.shape[0]
+    chunk_mean = X.mean(axis=0, dtype=np.float64)
+    chunk_m2 = ((X - chunk_mean) ** 2).sum(axis=0)
+    if self.count == 0:
+      self.count, self.mean, self.m2 = chunk_count, chunk_mean, chunk_m2
+      return self
+    if chunk_mean.shape != self.mean.shape:
+      raise ValueError('Expected %d features per row but got %d'
+                       % (self.mean.shape[0], chunk_mean.shape[0]))
+    count = self.count + chunk_count
+    delta = chunk_mean - self.mean
+    self.mean = self.mean + delta * (chunk_count / float(count))
+    self.m2 = self.m2 + chunk_m2 + delta ** 2 * (self.count * chunk_count
+                                                 / float(count))
+    self.count = count
+    return self
+
+  def fit(self, X, chunk_size=FEATURE_BATCH_SIZE):
+    """ compute the statistics of an N x D array of features; returns self """
+    self.__init__()
+    for chunk in iter_array_chunks(X, chunk_size):
+      self.partial_fit(chunk)
+    return self
+
+  @property
+  def std(self):
+    """ per-feature standard deviation, as np.std with ddof=0 """
+    if self.count == 0:
+      raise ValueError('FeatureStandardizer has not been fitted')
+    return np.sqrt(self.m2 / self.count)
+
+  def transform(self, X, out=None, chunk_size=FEATURE_BATCH_SIZE):
+    """
+    Standardize an N x D array of features chunk by chunk.
+
+    Inputs:
+    - X: Array of features, possibly a memmap.
+    - out: Optional array of the same shape to write to; pass out=X to
+      standardize a floating point X in place. If None, a new float64 array
+      is allocated.
+    - chunk_size: Number of rows processed at once, which bounds the size of
+      the temporaries.
+
+    Returns:
+    out, or the new array.
+    """
+    if self.count == 0:
+      raise ValueError('FeatureStandardizer has not been fitted')
+    if X.shape[1:] != self.mean.shape:
+      raise ValueError('Expected %d features per row but got %s'
+                       % (self.mean.shape[0], X.shape[1:]))
+    if out is None:
+      out = np.empty(X.shape)
+    std = self.std
+    scale = 1.0 / np.where(std > 0, std, 1.0)
+    for start in range(0, X.shape[0], chunk_size):
+      rows = slice(start, start + chunk_size)
+      out[rows] = (X[rows] - self.mean) * scale
+    if hasattr(out, 'flush'):
+      out.flush()
+    return out
+
+  def fit_transform(self, X, out=None, chunk_size=FEATURE_BATCH_SIZE):
+    """ fit on X and return transform(X, out, chunk_size) """
+    return self.fit(X, chunk_size).transform(X, out, chunk_size)
+
+  def save(self, path):
+    """ store the fitted statistics in an .npz file at path; returns the path """
+    if self.count == 0:
+      raise ValueError('FeatureStandardizer has not been fitted')
+    if not path.endswith('.npz'):
+      path += '.npz'
+    # Write to a temporary name first, as for the feature cache.
+    tmp_path = path[:-len('.npz')] + '.%d.tmp.npz' % os.getpid()
+    np.savez(tmp_path, count=self.count, mean=self.mean, m2=self.m2)
+    os.rename(tmp_path, path)
+    return path
+
+  @classmethod
+  def load(cls, path):
+    """ restore a FeatureStandardizer stored with save """
+    standardizer = cls()
+    with np.load(path) as stats:
+      standardizer.count = int(stats['count'])
+      standardizer.mean = stats['mean']
+      standardizer.m2 = stats['m2']
+    return standardizer
+
+
+def batch_feature_fn(feature_fn):
+  """
+  Return a function computing feature_fn for a whole N x H x W x C array of
+  images at once, or None if feature_fn has no batched version.
+
+  feature_fn may be a FeaturePipeline, a function registered in
+  BATCH_FEATURE_FNS or a functools.partial of one, e.g.
+  partial(color_histogram_hsv, nbin=12).
+  """
+  if isinstance(feature_fn, FeaturePipeline):
+    return feature_fn.transform
+  args, keywords = (), {}
+  if isinstance(feature_fn, functools.partial):
+    args, keywords = feature_fn.args, feature_fn.keywords or {}
+    feature_fn = feature_fn.func
+  try:
+    batch_fn = BATCH_FEATURE_FNS.get(feature_fn)
+  except TypeError:
+    return None
+  if batch_fn is None:
+    return None
+  return functools.partial(batch_fn, *args, **keywords)
+
+
 def rgb2gray(rgb):
   """Convert RGB image to grayscale
 
@@ -68,7 +431,7 @@ def rgb2gray(rgb):
   return np.dot(rgb[...,:3], [0.299, 0.587, 0.144])
 
 
-def hog_feature(im):
+def hog_feature(im, orientations=9, pixels_per_cell=(8, 8)):
   """Compute Histogram of Gradient (HOG) feature for an image
   
        Modified from skimage.feature.hog
@@ -80,6 +443,8 @@ def hog_feature(im):
      
     Parameters:
       im : an input grayscale or rgb image
+      orientations : number of gradient orientation bins over [0, 180)
+      pixels_per_cell : (rows, columns) of pixels in a cell
       
     Returns:
       feat: Histogram of Gradient (HOG) feature
@@ -90,36 +455,97 @@ def hog_feature(im):
   if im.ndim == 3:
     image = rgb2gray(im)
   else:
-    image = np.at_least_2d(im)
+    image = np.atleast_2d(im)
+
+  return hog_cell_histograms(image[np.newaxis], orientations,
+                             pixels_per_cell).ravel()
 
-  sx, sy = image.shape # image size
-  orientations = 9 # number of gradient bins
-  cx, cy = (8, 8) # pixels per cell
 
+def hog_features(imgs, orientations=9, pixels_per_cell=(8, 8)):
+  """Compute the HOG feature of hog_feature for a whole batch of images
+
+    Parameters:
+      imgs : N x H x W x C array of rgb images, or N x H x W array of
+             grayscale images
+      orientations, pixels_per_cell : as for hog_feature
+
+    Returns:
+      feats: N x F array whose ith row equals hog_feature(imgs[i])
+
+  """
+  # convert rgb to grayscale if needed
+  if imgs.ndim == 4:
+    image = rgb2gray(imgs)
+  else:
+    image = imgs
+
+  return hog_cell_histograms(image, orientations,
+                             pixels_per_cell).reshape(image.shape[0], -1)
+
+
+def hog_cell_histograms(image, orientations=9, pixels_per_cell=(8, 8)):
+  """Orientation histograms of the cells of a batch of grayscale images
+
+    Every pixel's gradient magnitude is scattered into the histogram bin of
+    its cell and orientation with a single bincount, so the cost does not grow
+    with the number of orientation bins. Pixels with an orientation of exactly
+    0 or outside [0, 180), and pixels in partial cells at the bottom or right
+    border, are not counted.
+
+    Parameters:
+      image : N x H x W array of grayscale images
+      orientations, pixels_per_cell : as for hog_feature
+
+    Returns:
+      hist: N x n_cellsy x n_cellsx x orientations array holding, for every
+            (column cell, row cell) pair, the mean gradient magnitude of the
+            cell's pixels in each orientation bin
+
+  """
+  grad_mag, grad_ori = hog_gradients(image)
+  return bin_gradients(grad_mag, grad_ori, orientations, pixels_per_cell)
+
+
+def hog_gradients(image):
+  """Gradient magnitudes and orientations (in degrees, 0 to 270) of a batch
+     of N x H x W grayscale images, as used by hog_feature"""
   gx = np.zeros(image.shape)
   gy = np.zeros(image.shape)
-  gx[:, :-1] = np.diff(image, n=1, axis=1) # compute gradient on x-direction
-  gy[:-1, :] = np.diff(image, n=1, axis=0) # compute gradient on y-direction
+  gx[:, :, :-1] = np.diff(image, n=1, axis=2) # compute gradient on x-direction
+  gy[:, :-1, :] = np.diff(image, n=1, axis=1) # compute gradient on y-direction
   grad_mag = np.sqrt(gx ** 2 + gy ** 2) # gradient magnitude
   grad_ori = np.arctan2(gy, (gx + 1e-15)) * (180 / np.pi) + 90 # gradient orientation
+  return grad_mag, grad_ori
+
+
+def bin_gradients(grad_mag, grad_ori, orientations=9, pixels_per_cell=(8, 8)):
+  """Cell orientation histograms from the output of hog_gradients; see
+     hog_cell_histograms"""
+  num_images, sx, sy = grad_mag.shape # batch and image size
+  cx, cy = pixels_per_cell # pixels per cell
 
   n_cellsx = int(np.floor(sx / cx))  # number of cells in x
   n_cellsy = int(np.floor(sy / cy))  # number of cells in y
-  # compute orientations integral images
-  orientation_histogram = np.zeros((n_cellsx, n_cellsy, orientations))
-  for i in range(orientations):
-    # create new integral image for this orientation
-    # isolate orientations in this range
-    temp_ori = np.where(grad_ori < 180 / orientations * (i + 1),
-                        grad_ori, 0)
-    temp_ori = np.where(grad_ori >= 180 / orientations * i,
-                        temp_ori, 0)
-    # select magnitudes for those orientations
-    cond2 = temp_ori > 0
-    temp_mag = np.where(cond2, grad_mag, 0)
-    orientation_histogram[:,:,i] = uniform_filter(temp_mag, size=(cx, cy))[int(cx/2)::cx, int(cy/2)::cy].T
-  
-  return orientation_histogram.ravel()
+  grad_mag = grad_mag[:, :n_cellsx * cx, :n_cellsy * cy]
+  grad_ori = grad_ori[:, :n_cellsx * cx, :n_cellsy * cy]
+
+  # Orientation bin of every pixel: edges[b] <= ori < edges[b + 1].
+  edges = 180 / orientations * np.arange(orientations + 1)
+  bins = np.searchsorted(edges, grad_ori, side='right') - 1
+  counted = (grad_ori > 0) & (bins < orientations)
+
+  # Flat histogram index of every pixel: image, column cell, row cell, bin.
+  rows = np.arange(n_cellsx * cx) // cx
+  cols = np.arange(n_cellsy * cy) // cy
+  cells = cols[np.newaxis, :] * n_cellsx + rows[:, np.newaxis]
+  images = np.arange(num_images)[:, np.newaxis, np.newaxis]
+  index = (images * (n_cellsy * n_cellsx) + cells) * orientations
+  index = index + np.where(counted, bins, 0)
+
+  hist = np.bincount(index.ravel(), weights=np.where(counted, grad_mag, 0).ravel(),
+                     minlength=num_images * n_cellsy * n_cellsx * orientations)
+  hist /= cx * cy
+  return hist.reshape(num_images, n_cellsy, n_cellsx, orientations)
 
 
 def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
@@ -147,4 +573,169 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   return imhist
 
 
-pass
+def rgb_to_hue(rgb):
+  """
+  Hue channel of matplotlib.colors.rgb_to_hsv(rgb), computed without the
+  saturation and value channels.
+
+  Inputs:
+  - rgb: ... x 3 array of RGB values in [0, 1].
+
+  Returns:
+    Array of the leading shape of rgb with hues in [0, 1).
+  """
+  r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+  arr_max = np.maximum(np.maximum(r, g), b)
+  delta = arr_max - np.minimum(np.minimum(r, g), b)
+  colored = delta > 0
+  delta = np.where(colored, delta, 1)
+  # As in rgb_to_hsv, blue wins over green and green over red when tied.
+  hue = np.where(r == arr_max, (g - b) / delta, 0)
+  hue = np.where(g == arr_max, 2. + (b - r) / delta, hue)
+  hue = np.where(b == arr_max, 4. + (r - g) / delta, hue)
+  hue = np.where(colored, hue, 0)
+  return (hue / 6.0) % 1.0
+
+
+def color_histograms_hsv(imgs, nbin=10, xmin=0, xmax=255, normalized=True):
+  """
+  Compute the hue histogram of color_histogram_hsv for a whole batch of images.
+
+  Only the hue channel is computed, for all images at once and with the same
+  arithmetic as matplotlib.colors.rgb_to_hsv, and the histograms of all images
+  are counted with a single bincount, offsetting the bin index of each image by
+  nbin times its position in the batch.
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data for N RGB images.
+  - nbin, xmin, xmax, normalized: As for color_histogram_hsv.
+
+  Returns:
+    N x nbin array whose ith row equals color_histogram_hsv(imgs[i], ...).
+  """
+  return hue_histograms(rgb_to_hue(imgs/xmax) * xmax, nbin, xmin, xmax,
+                        normalized)
+
+
+def hue_histograms(hue, nbin=10, xmin=0, xmax=255, normalized=True):
+  """
+  Histograms of a batch of hue images scaled to [0, xmax], binned like
+  color_histogram_hsv; see color_histograms_hsv.
+  """
+  num_images = hue.shape[0]
+  bins = np.linspace(xmin, xmax, nbin+1)
+  hue = hue.reshape(num_images, -1)
+
+  # Same binning as np.histogram: bins[b] <= hue < bins[b + 1], except that the
+  # last bin also holds hue == xmax; values outside [xmin, xmax] are dropped.
+  index = np.searchsorted(bins, hue, side='right') - 1
+  index[hue == bins[-1]] = nbin - 1
+  inside = (hue >= bins[0]) & (hue <= bins[-1])
+  index += np.arange(num_images)[:, np.newaxis] * nbin
+  counts = np.bincount(index[inside], minlength=num_images * nbin)
+  counts = counts.reshape(num_images, nbin)
+
+  bin_widths = np.diff(bins)
+  if normalized:
+    imhist = counts / bin_widths / counts.sum(axis=1, keepdims=True)
+  else:
+    imhist = counts
+  return imhist * bin_widths
+
+
+# Batched versions of per-image feature functions, used by extract_features.
+BATCH_FEATURE_FNS = {
+  hog_feature: hog_features,
+  color_histogram_hsv: color_histograms_hsv,
+}
+
+
+class FeatureBatch(object):
+  """
+  A batch of images together with the intermediates computed from it so far.
+
+  Pipeline steps ask for intermediates by name with get, e.g.
+  batch.get('gradients') or batch.get('hue', 255). The first request computes
+  the intermediate with the function registered in INTERMEDIATES, which may in
+  turn request others; later requests from any step reuse the result.
+  """
+
+  def __init__(self, imgs):
+    self.imgs = imgs
+    self.num_images = imgs.shape[0]
+    self._cache = {}
+
+  def get(self, name, *params):
+    key = (name,) + params
+    if key not in self._cache:
+      self._cache[key] = INTERMEDIATES[name](self, *params)
+    return self._cache[key]
+
+
+def _gray(batch):
+  """ N x H x W grayscale images """
+  if batch.imgs.ndim == 4:
+    return rgb2gray(batch.imgs)
+  return batch.imgs
+
+
+def _gradients(batch):
+  """ (grad_mag, grad_ori) of the grayscale images, from hog_gradients """
+  return hog_gradients(batch.get('gray'))
+
+
+def _hue(batch, xmax):
+  """ N x H x W hue images of RGB images with values in [0, xmax], in [0, xmax) """
+  return rgb_to_hue(batch.imgs/xmax) * xmax
+
+
+# Intermediates a FeatureBatch can compute, by name. A function registered here
+# takes the batch and any parameters given to FeatureBatch.get.
+INTERMEDIATES = {
+  'gray': _gray,
+  'gradients': _gradients,
+  'hue': _hue,
+}
+
+
+def hog_step(batch, orientations=9, pixels_per_cell=(8, 8)):
+  """ pipeline step computing hog_features from the shared gradients """
+  grad_mag, grad_ori = batch.get('gradients')
+  hist = bin_gradients(grad_mag, grad_ori, orientations, pixels_per_cell)
+  return hist.reshape(batch.num_images, -1)
+
+
+def color_histogram_hsv_step(batch, nbin=10, xmin=0, xmax=255, normalized=True):
+  """ pipeline step computing color_histograms_hsv from the shared hue """
+  return hue_histograms(batch.get('hue', xmax), nbin, xmin, xmax, normalized)
+
+
+class FeaturePipeline(object):
+  """
+  A list of feature steps that share per-batch intermediates.
+
+  Every step is a function taking a FeatureBatch and returning an N x F_i
+  array, such as hog_step or functools.partial(color_histogram_hsv_step,
+  nbin=12). Intermediates such as grayscale images, gradients and hues are
+  computed once per batch, so a new gradient- or color-based step only costs
+  its final binning. New intermediates are added to INTERMEDIATES.
+
+  A pipeline can be passed to extract_features (and the streaming, caching and
+  parallel variants) like any feature function: it is then applied to whole
+  chunks of images at once.
+  """
+
+  def __init__(self, steps):
+    self.steps = list(steps)
+
+  def transform(self, imgs):
+    """
+    Compute the features of every step for an N x H x W x C array of images
+    and return them concatenated in an N x (F_1 + ... + F_k) array.
+    """
+    batch = FeatureBatch(imgs)
+    return np.hstack([step(batch) for step in self.steps])
+
+  def __call__(self, im):
+    """ features of a single H x W x C image, like a per-image feature function """
+    return self.transform(im[np.newaxis])[0]
@@ -0,0 +1,66 @@
+import weakref
+
+import numpy as np
+
+
+def share_array(arr):
+  """
+  Copy a numpy array into a new block of shared memory.
+
+  Inputs:
+  - arr: The numpy array to share.
+
+  Returns a tuple of:
+  - shm: The multiprocessing.shared_memory.SharedMemory block. The caller owns
+    it and must keep a reference for as long as workers use it; release it with
+    release_shared.
+  - spec: A small picklable tuple that worker processes pass to attach_array.
+  """
+  from multiprocessing import shared_memory
+
+  shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+  shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+  shared[...] = arr
+  return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def empty_shared(shape, dtype=np.float64):
+  """
+  Allocate an uninitialized numpy array in a new block of shared memory.
+
+  Returns a tuple (shm, spec, arr) where shm and spec are as for share_array
+  and arr is a numpy array backed by the shared block.
+  """
+  from multiprocessing import shared_memory
+
+  dtype = np.dtype(dtype)
+  nbytes = int(np.prod(shape)) * dtype.itemsize
+  shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+  arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+  return shm, (shm.name, tuple(shape), dtype.str), arr
+
+
+def attach_array(spec):
+  """
+  Attach to an array shared by share_array or empty_shared.
+
+  Returns a tuple (shm, arr). The numpy array arr is only valid while shm is
+  referenced, so keep both alive together.
+  """
+  from multiprocessing import shared_memory
+
+  name, shape, dtype = spec
+  shm = shared_memory.SharedMemory(name=name)
+  return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def release_shared(*shms):
+  """ close and unlink shared memory blocks created by this process """
+  for shm in shms:
+    shm.close()
+    shm.unlink()
+
+
+def release_on_collect(owner, *shms):
+  """ release the given shared memory blocks once owner is garbage collected """
+  return weakref.finalize(owner, release_shared, *shms)